@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Time each stage of the HFA pipeline against a synthetic tree.
+
+Stages: DataImporter parse/merge/save, HFAIndex build (cold and
+cached) and lookups, Plot.get_plot_dataset, and
+SmallMultipleChart render and savefig. Results are written as JSON;
+with --baseline, stages slower than the baseline by more than
+--tolerance are reported and the exit status is 1.
+
+Run from the repository root, e.g.:
+
+    python -m benchmarks.run --countries 50 --years 40 --indicators 20 \\
+        --output bench.json --baseline benchmarks/baseline.json
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import pandas as pd
+import yaml
+
+from benchmarks.synthetic import generate, COUNTRY_EN
+from hfa.importer import DataImporter
+from hfa.indices import Extractor, HFAIndex
+from hfa.plot import Plot, SmallMultipleChart
+
+
+class Timer(object):
+    '''Collect the seconds of repeated runs per stage.'''
+
+    def __init__(self):
+        self.runs = {}
+
+    def add(self, stage, seconds):
+        self.runs.setdefault(stage, []).append(seconds)
+
+    def time(self, stage, func, *args, **kwargs):
+        start = time.time()
+        result = func(*args, **kwargs)
+        self.add(stage, time.time() - start)
+        return result
+
+    def summary(self):
+        return dict((stage, {'seconds': min(runs), 'runs': runs})
+                    for stage, runs in self.runs.items())
+
+
+def bench_import(timer, args, work_dir):
+    importer = None
+    for _ in range(args.repeat):
+        shutil.rmtree(os.path.join(work_dir, 'data'), ignore_errors=True)
+        tree = generate(work_dir, args.countries, args.years, args.indicators,
+                        args.specs, args.facets, args.missing, args.seed)
+        importer = timer.time('import.total', DataImporter,
+                              processes=args.processes)
+        for stage, seconds in importer.timings.items():
+            timer.add('import.' + stage, seconds)
+        timer.time('import.compact', importer.compact)
+    return tree, importer
+
+
+def bench_index(timer, args, tree):
+    index_dir = tree['index_dir']
+    index = None
+    for _ in range(args.repeat):
+        cache = os.path.join(index_dir, Extractor.CACHE)
+        if os.path.exists(cache):
+            os.remove(cache)
+        timer.time('index.build_cold', HFAIndex, index_dir)
+        index = timer.time('index.build_cached', HFAIndex, index_dir)
+
+    rng = random.Random(args.seed)
+    names = [COUNTRY_EN.format(int(c)) for c in tree['countries']]
+    ids = tree['indicators']
+
+    def lookups():
+        for _ in range(args.lookups):
+            index.get_countries(names=[rng.choice(names)])
+            index.get_indicators(ids=[rng.choice(ids)])
+    for _ in range(args.repeat):
+        timer.time('index.lookups', lookups)
+    return index
+
+
+def bench_plots(timer, args, tree, importer, index):
+    specs = []
+    for path in tree['spec_files']:
+        with open(path, 'r') as f:
+            specs.append(yaml.safe_load(f))
+    series = importer.series
+
+    for _ in range(args.repeat):
+        plots = [timer.time('plot.get_plot_dataset', Plot, dict(s), index, series)
+                 for s in specs]
+        for plot in plots:
+            chart = SmallMultipleChart(plot, Plot.LANGS)
+            save_fig = chart._save_fig
+
+            def timed_save(*a):
+                timer.time('render.savefig', save_fig, *a)
+            chart._save_fig = timed_save
+            timer.time('render.total', chart.render)
+
+
+def compare(results, baseline, tolerance):
+    '''Return (stage, current, baseline, ratio) of regressed stages.'''
+    regressions = []
+    for stage, current in sorted(results['stages'].items()):
+        base = baseline.get('stages', {}).get(stage)
+        if not base or not base['seconds']:
+            continue
+        ratio = current['seconds'] / base['seconds']
+        print('{:28s} {:9.4f}s  baseline {:9.4f}s  x{:.2f}'.format(
+            stage, current['seconds'], base['seconds'], ratio))
+        if ratio > tolerance:
+            regressions.append((stage, current['seconds'], base['seconds'], ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the HFA pipeline.')
+    parser.add_argument('--countries', type=int, default=50)
+    parser.add_argument('--years', type=int, default=40)
+    parser.add_argument('--indicators', type=int, default=10)
+    parser.add_argument('--specs', type=int, default=4)
+    parser.add_argument('--facets', type=int, default=12)
+    parser.add_argument('--missing', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=None,
+                        help='import process pool size')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per stage; the fastest is reported')
+    parser.add_argument('--lookups', type=int, default=1000)
+    parser.add_argument('--skip-render', action='store_true')
+    parser.add_argument('--output', help='write the JSON results here')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='slowdown ratio that counts as a regression')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the synthetic working tree')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='hfa-bench-')
+    timer = Timer()
+    os.chdir(work_dir)  # the pipeline resolves ./data, ./img relative to cwd
+    try:
+        tree, importer = bench_import(timer, args, work_dir)
+        index = bench_index(timer, args, tree)
+        if not args.skip_render:
+            bench_plots(timer, args, tree, importer, index)
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print('Synthetic tree kept in {}'.format(work_dir))
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {'params': dict((k, v) for k, v in vars(args).items()
+                              if k not in ('output', 'baseline', 'keep')),
+               'environment': {'python': platform.python_version(),
+                               'numpy': np.__version__,
+                               'pandas': pd.__version__,
+                               'matplotlib': matplotlib.__version__,
+                               'machine': platform.machine()},
+               'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'stages': timer.summary()}
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    else:
+        print(json.dumps(results['stages'], indent=1, sort_keys=True))
+
+    if baseline:
+        with open(baseline, 'r') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for stage, current, base, ratio in regressions:
+            print('REGRESSION {}: {:.4f}s vs {:.4f}s (x{:.2f})'.format(
+                stage, current, base, ratio))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Generate a synthetic HFA working tree of a chosen size:
+
+    <work_dir>/data/raw/*.html       one 'Table A' page per indicator
+    <work_dir>/hfa/index_data/       raw_{countries,indicators}_{en,ru}.txt
+    <work_dir>/yaml/*.yaml           small-multiples plot specs
+
+Names follow the formats that DataImporter and Extractor parse,
+so the real pipeline can be run against it unchanged.
+"""
+from __future__ import print_function
+import argparse
+import codecs
+import os
+import random
+
+YEARS_FROM = 1970
+COUNTRY_EN = u'Country {:04d}'
+COUNTRY_RU = u'Страна {:04d}'
+INDICATOR_EN = u'Synthetic indicator {:04d}, per 100000'
+INDICATOR_RU = u'Синтетический показатель {:04d}, на 100000'
+
+
+def country_ids(n):
+    return [u'{:04d}'.format(i) for i in range(1, n + 1)]
+
+
+def indicator_ids(n):
+    return [u'{:04d}'.format(1000 + i) for i in range(1, n + 1)]
+
+
+def write_table_a(path, indicator, countries, years, rng, missing=0.1):
+    '''Write one HFA 'Table A' HTML page with random values.'''
+    lines = ['<html><head><meta http-equiv="Content-Type" '
+             'content="text/html; charset=utf-8"></head><body>',
+             '<table border="1">',
+             '<tr><td colspan="{}">{}</td></tr>'.format(len(years) + 1, indicator),
+             '<tr><td></td>' + ''.join('<td>{}</td>'.format(y) for y in years) + '</tr>']
+    for idx in countries:
+        level = rng.uniform(50, 900)
+        cells = []
+        for _ in years:
+            level = max(1.0, level * rng.uniform(0.95, 1.05))
+            cells.append('...' if rng.random() < missing else '{:.2f}'.format(level))
+        lines.append(u'<tr><td>{} {}</td>'.format(idx, COUNTRY_EN.format(int(idx)))
+                     + ''.join('<td>{}</td>'.format(c) for c in cells) + '</tr>')
+    lines.append('</table></body></html>')
+    with codecs.open(path, 'w', 'utf-8') as f:
+        f.write(u'\n'.join(lines))
+
+
+def write_index(index_dir, countries, indicators):
+    '''Write the four cp1251 raw index files in the WHO JavaScript layout.'''
+    names = {('countries', 'en'): COUNTRY_EN, ('countries', 'ru'): COUNTRY_RU,
+             ('indicators', 'en'): INDICATOR_EN, ('indicators', 'ru'): INDICATOR_RU}
+    ids = {'countries': countries, 'indicators': indicators}
+    for (index_type, lang), fmt in names.items():
+        fn = os.path.join(index_dir, 'raw_{}_{}.txt'.format(index_type, lang))
+        entries = [u" ['{} {}',1,],".format(idx, fmt.format(int(idx)))
+                   for idx in ids[index_type]]
+        with codecs.open(fn, 'w', 'cp1251') as f:
+            f.write(u"[['EUROPE',,,\n" + u'\n'.join(entries) + u'\n]]\n')
+
+
+def write_specs(yaml_dir, indicators, countries, years, count=4, facets=12):
+    '''Write `count` small-multiples specs of `facets` countries each.'''
+    paths = []
+    facets = min(facets, len(countries) - 1)
+    for n, idx in enumerate(indicators[:count]):
+        chosen = countries[n % len(countries):][:facets] or countries[:facets]
+        comparator = countries[-1]
+        path = os.path.join(yaml_dir, 'bench_{}.yaml'.format(idx))
+        lines = ["indicator: '{}'".format(idx),
+                 'type: Small multiples',
+                 'xmin: {}'.format(years[0]),
+                 'xmax: {}'.format(years[-1]),
+                 'xstep: 10',
+                 'dpi: 96',
+                 'width: 960',
+                 'height: 602',
+                 'countries:']
+        lines += ['- {}'.format(COUNTRY_EN.format(int(c))) for c in chosen]
+        lines += ['comparators:', '- {}'.format(COUNTRY_EN.format(int(comparator))),
+                  'filename: bench_{}'.format(idx)]
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        paths.append(path)
+    return paths
+
+
+def generate(work_dir, countries=50, years=40, indicators=10,
+             specs=4, facets=12, missing=0.1, seed=0):
+    '''
+    Build a synthetic working tree under `work_dir`.
+
+    Returns
+    ----------
+    A dict of the generated country and indicator ids, years and
+    the paths of the raw files and specs.
+    '''
+    rng = random.Random(seed)
+    raw_dir = os.path.join(work_dir, 'data', 'raw')
+    index_dir = os.path.join(work_dir, 'hfa', 'index_data')
+    yaml_dir = os.path.join(work_dir, 'yaml')
+    for d in [raw_dir, index_dir, yaml_dir, os.path.join(work_dir, 'img')]:
+        if not os.path.exists(d):
+            os.makedirs(d)
+
+    c_ids = country_ids(countries)
+    i_ids = indicator_ids(indicators)
+    year_list = list(range(YEARS_FROM, YEARS_FROM + years))
+    raw_files = []
+    for idx in i_ids:
+        path = os.path.join(raw_dir, 'table_a_{}.html'.format(idx))
+        write_table_a(path, INDICATOR_EN.format(int(idx)), c_ids, year_list,
+                      rng, missing)
+        raw_files.append(path)
+    write_index(index_dir, c_ids, i_ids)
+    spec_files = write_specs(yaml_dir, i_ids, c_ids, year_list, specs, facets)
+    return {'countries': c_ids, 'indicators': i_ids, 'years': year_list,
+            'raw_files': raw_files, 'spec_files': spec_files,
+            'index_dir': index_dir}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('work_dir')
+    parser.add_argument('--countries', type=int, default=50)
+    parser.add_argument('--years', type=int, default=40)
+    parser.add_argument('--indicators', type=int, default=10)
+    parser.add_argument('--specs', type=int, default=4)
+    parser.add_argument('--facets', type=int, default=12)
+    parser.add_argument('--missing', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    tree = generate(args.work_dir, args.countries, args.years, args.indicators,
+                    args.specs, args.facets, args.missing, args.seed)
+    print('Generated {} raw files and {} specs in {}'.format(
+        len(tree['raw_files']), len(tree['spec_files']), args.work_dir))
+
+
+if __name__ == '__main__':
+    main()
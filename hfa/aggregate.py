@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Regional aggregates computed from the country data.
+
+An Aggregator wraps a hfa.series.SeriesIndex and answers the same
+query() calls, additionally accepting group labels of the form
+
+    mean(<country set>)     unweighted mean of the members
+    wmean(<country set>)    mean weighted by mid-year population (0010)
+
+where <country set> is a key of hfa/index_data/country_sets.yaml.
+Such labels can therefore be used directly as `comparators` in plot
+specs. A group is computed for every indicator and year in one
+vectorized pass and cached for the life of the Aggregator.
+"""
+import re
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from hfa.store import COLUMNS
+
+POPULATION = u'0010'  # Mid-year population
+AGGREGATE = re.compile(r'^(w?mean)\((.+)\)$')
+
+# country_id given to aggregate rows, which belong to no country
+AGGREGATE_ID = -1
+
+
+def is_aggregate(label):
+    return isinstance(label, basestring) and AGGREGATE.match(label) is not None
+
+
+class Aggregator(object):
+    '''
+    Group means over any country set, weighted by population or not.
+
+    Parameters
+    ----------
+    data: hfa.series.SeriesIndex
+       The country-level data.
+    index: hfa.indices.HFAIndex
+       Used to resolve the population indicator's name.
+    country_sets: dict
+       Set name -> list of English country names, as in country_sets.yaml.
+    population: unicode (optional)
+       Id of the indicator used as weights, defaults to 0010.
+    '''
+
+    def __init__(self, data, index, country_sets, population=POPULATION):
+        self.data = data
+        self.index = index
+        self.country_sets = dict((k.lower(), v) for k, v in country_sets.items())
+        self.population = index.get_name(population)
+        self._arrays = None
+        self._weights = None
+        self._cache = {}
+
+    def __getattr__(self, name):
+        # Stand in for the wrapped data everywhere else
+        if name.startswith('_') or name == 'data':
+            raise AttributeError(name)
+        return getattr(self.data, name)
+
+    def __contains__(self, indicator):
+        return indicator in self.data
+
+    def members(self, group):
+        '''Return the English names of the countries in a country set.'''
+        try:
+            return list(self.country_sets[group.lower()])
+        except KeyError:
+            raise ValueError('Unknown country set {!r}; define it in '
+                             'country_sets.yaml'.format(group))
+
+    def _long_arrays(self):
+        '''All indicators concatenated once as (indicator code, country_id,
+        year, value) arrays, plus the year range.'''
+        if self._arrays is None:
+            parts = [self.data.columns(i) for i in self.data.indicators]
+            lengths = [len(p['year']) for p in parts]
+            code = np.repeat(np.arange(len(parts)), lengths)
+            cid = np.concatenate([p['country_id'] for p in parts]).astype(np.intp)
+            year = np.concatenate([p['year'] for p in parts]).astype(np.intp)
+            value = np.concatenate([p['value'] for p in parts])
+            self._arrays = code, cid, year, value, year.min(), year.max()
+        return self._arrays
+
+    def _population(self):
+        '''Dense country_id x year matrix of population, NaN where missing.'''
+        if self._weights is None:
+            if self.population not in self.data:
+                raise ValueError('Population-weighted means need indicator {} '
+                                 '({}) in the data; use mean() instead.'
+                                 .format(POPULATION, self.population))
+            _, _, _, _, first, last = self._long_arrays()
+            part = self.data.columns(self.population)
+            weights = np.empty((max(self.data.countries) + 1, last - first + 1))
+            weights.fill(np.nan)
+            years = part['year'].astype(np.intp)
+            inside = (years >= first) & (years <= last)
+            weights[part['country_id'][inside].astype(np.intp),
+                    years[inside] - first] = part['value'][inside]
+            self._weights = weights
+        return self._weights
+
+    def compute(self, group, weighted=False):
+        '''
+        Return the group mean for every indicator and year as a dict of
+        arrays: indicator (name), year, value and members (the number
+        of countries that contributed). Only (indicator, year) cells
+        with at least one contributing member are included.
+        '''
+        members = self.members(group)
+        key = (tuple(sorted(members)), weighted)
+        if key in self._cache:
+            return self._cache[key]
+
+        code, cid, year, value, first, last = self._long_arrays()
+        ids = [self.data.country_ids[m] for m in members
+               if m in self.data.country_ids]
+        mask = np.in1d(cid, ids)
+        code, cid, year, value = code[mask], cid[mask], year[mask], value[mask]
+        if weighted:
+            weights = self._population()[cid, year - first]
+        else:
+            weights = np.ones(len(value))
+        ok = ~np.isnan(weights) & ~np.isnan(value)
+
+        years = last - first + 1
+        size = len(self.data.indicators) * years
+        cell = code[ok] * years + (year[ok] - first)
+        total = np.bincount(cell, weights=weights[ok] * value[ok], minlength=size)
+        weight = np.bincount(cell, weights=weights[ok], minlength=size)
+        count = np.bincount(cell, minlength=size)
+        cells = np.flatnonzero((count > 0) & (weight > 0))
+
+        names = np.array(self.data.indicators, dtype=object)
+        result = {'indicator': names[cells // years],
+                  'year': (cells % years + first).astype(np.int64),
+                  'value': total[cells] / weight[cells],
+                  'members': count[cells]}
+        self._cache[key] = result
+        return result
+
+    def aggregate_frame(self, label, indicator, start=None, end=None):
+        '''Rows of one group label for one indicator, in query() format.'''
+        kind, group = AGGREGATE.match(label).groups()
+        result = self.compute(group, weighted=(kind == 'wmean'))
+        rows = result['indicator'] == indicator
+        if start is not None:
+            rows &= result['year'] >= start
+        if end is not None:
+            rows &= result['year'] <= end
+        n = rows.sum()
+        labels = np.empty(n, dtype=object)
+        labels.fill(label)
+        indicators = np.empty(n, dtype=object)
+        indicators.fill(indicator)
+        return pd.DataFrame({'country_id': np.repeat(np.int64(AGGREGATE_ID), n),
+                             'country': labels,
+                             'indicator': indicators,
+                             'year': result['year'][rows],
+                             'value': result['value'][rows]},
+                            columns=COLUMNS)
+
+    def query(self, indicator, countries, start=None, end=None):
+        '''
+        As SeriesIndex.query, where `countries` may also contain
+        mean(<set>) and wmean(<set>) labels.
+        '''
+        countries = list(OrderedDict.fromkeys(countries))  # each once
+        groups = [c for c in countries if is_aggregate(c)]
+        plain = [c for c in countries if not is_aggregate(c)]
+        data = self.data.query(indicator, plain, start, end)
+        if not groups:
+            return data
+        frames = [data] + [self.aggregate_frame(g, indicator, start, end)
+                           for g in groups]
+        data = pd.concat(frames, ignore_index=True)
+        order = np.argsort(np.asarray(data['year']), kind='mergesort')
+        return data.take(order).reset_index(drop=True)
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Which countries and years have data, per indicator, without reading
+the data rows.
+
+The coverage of an indicator is a country x year availability bitmap
+plus, per country, the first and last year with a value and the
+smallest and largest value. It is built when the store is written --
+by migration, imports and compaction -- and kept next to the store
+manifest in coverage.pkl, stamped with the store version, so it
+answers questions such as
+
+    coverage = DataImporter().coverage
+    coverage.empty_facets(name, ['Malta', 'Albania'], 1990, 2010)
+    coverage.latest_year(name)              # {country: year}
+    coverage.extents(name, countries)       # default axis limits
+
+at the cost of one small file read. Only the indicators an import
+touched are recomputed; a file that does not match the store version
+is rebuilt from all partitions on the next load.
+"""
+import cPickle as pickle
+import os
+
+import numpy as np
+
+from hfa import trace
+from hfa.store import replace_file
+
+COVERAGE = 'coverage.pkl'
+COVERAGE_VERSION = 3
+
+
+def indicator_coverage(part):
+    '''
+    Summarise the columns of one store partition.
+
+    Returns
+    ----------
+    A dict of
+    country_ids: int array of the countries with any value, ascending
+    first_year: int, the year of the first bitmap column
+    width: int, the number of bitmap columns
+    bits: uint8 array, the (countries, years) bitmap packed along years
+    first, last: int arrays, each country's first and last year
+    vmin, vmax: float arrays, each country's smallest and largest value
+    '''
+    value = np.asarray(part['value'], dtype=np.float64)
+    keep = ~np.isnan(value)
+    cid = np.asarray(part['country_id'], dtype=np.int64)[keep]
+    year = np.asarray(part['year'], dtype=np.int64)[keep]
+    value = value[keep]
+    if not len(year):
+        return None
+    # rows are sorted by (country_id, year): each country is one run
+    country_ids, starts = np.unique(cid, return_index=True)
+    ends = np.append(starts[1:], len(cid))
+    first_year = int(year.min())
+    width = int(year.max()) - first_year + 1
+    bitmap = np.zeros((len(country_ids), width), dtype=bool)
+    bitmap[np.searchsorted(country_ids, cid), year - first_year] = True
+    return {'country_ids': country_ids,
+            'first_year': first_year,
+            'width': width,
+            'bits': np.packbits(bitmap, axis=1),
+            'first': year[starts],
+            'last': year[ends - 1],
+            'vmin': np.minimum.reduceat(value, starts),
+            'vmax': np.maximum.reduceat(value, starts)}
+
+
+class Coverage(object):
+    '''
+    Availability bitmaps and extents of every indicator in a store.
+
+    Parameters
+    ----------
+    version: string
+       The store version this coverage describes.
+    countries: dict
+       country_id -> English country name.
+    entries: dict
+       English indicator name -> dict of indicator_coverage().
+    '''
+
+    def __init__(self, version, countries, entries):
+        self.version = version
+        self.countries = countries
+        self.country_ids = dict((name, cid) for cid, name in countries.items())
+        self.entries = entries
+
+    @classmethod
+    def build(cls, store, previous=None, indicators=None):
+        '''
+        Summarise `store`, recomputing only `indicators` (English names)
+        and reusing the other entries of `previous`; everything if
+        either is None.
+        '''
+        entries = {}
+        with trace.span('coverage.build'):
+            for indicator in store.indicators:
+                if (previous is not None and indicators is not None
+                        and indicator not in indicators
+                        and indicator in previous.entries):
+                    entries[indicator] = previous.entries[indicator]
+                    continue
+                entry = indicator_coverage(store.partition(indicator))
+                store.release(indicator)
+                if entry is not None:
+                    entries[indicator] = entry
+        return cls(store.version, store.countries, entries)
+
+    @classmethod
+    def read(cls, store_dir):
+        '''The coverage saved in `store_dir`, or None.'''
+        try:
+            with open(os.path.join(store_dir, COVERAGE), 'rb') as f:
+                saved = pickle.load(f)
+            if saved['format'] == COVERAGE_VERSION:
+                return cls(saved['version'], saved['countries'], saved['entries'])
+        except (IOError, EOFError, KeyError, TypeError, pickle.PickleError):
+            pass
+        return None
+
+    @classmethod
+    def load(cls, store):
+        '''The coverage of `store`, rebuilt and saved if out of date.'''
+        coverage = cls.read(store.store_dir)
+        if coverage is None or coverage.version != store.version:
+            coverage = cls.build(store)
+            coverage.save(store.store_dir)
+        return coverage
+
+    @classmethod
+    def refresh(cls, store, indicators, since):
+        '''
+        Update the saved coverage after a write to `store` that
+        changed only `indicators`. The saved entries are reused only
+        if they describe store version `since`, the one before the write.
+        '''
+        previous = cls.read(store.store_dir)
+        if previous is None or previous.version != since:
+            indicators = None
+        coverage = cls.build(store, previous, indicators)
+        coverage.save(store.store_dir)
+        return coverage
+
+    def save(self, store_dir):
+        if not os.path.exists(store_dir):
+            return  # nothing stored yet
+        path = os.path.join(store_dir, COVERAGE)
+        try:
+            with open(path + '.tmp', 'wb') as f:
+                pickle.dump({'format': COVERAGE_VERSION,
+                             'version': self.version,
+                             'countries': self.countries,
+                             'entries': self.entries}, f, pickle.HIGHEST_PROTOCOL)
+            replace_file(path + '.tmp', path)
+        except (IOError, OSError):
+            pass  # a read-only store is summarised again on every load
+
+    def __contains__(self, indicator):
+        return indicator in self.entries
+
+    @property
+    def indicators(self):
+        return sorted(self.entries)
+
+    def bitmap(self, indicator):
+        '''
+        Return (country_ids, years, available) where `available` is a
+        bool array of shape (countries, years).
+        '''
+        entry = self.entries[indicator]
+        years = np.arange(entry['first_year'], entry['first_year'] + entry['width'])
+        bits = np.unpackbits(entry['bits'], axis=1)[:, :entry['width']]
+        return entry['country_ids'], years, bits.astype(bool)
+
+    def _rows(self, entry, countries):
+        '''Row of each country name in an entry, -1 if it has no data.'''
+        rows = np.empty(len(countries), dtype=np.intp)
+        rows.fill(-1)
+        for i, country in enumerate(countries):
+            cid = self.country_ids.get(country)
+            if cid is None:
+                continue
+            pos = np.searchsorted(entry['country_ids'], cid)
+            if pos < len(entry['country_ids']) and entry['country_ids'][pos] == cid:
+                rows[i] = pos
+        return rows
+
+    def _window(self, entry, start, end):
+        lo = 0 if start is None else max(0, start - entry['first_year'])
+        hi = entry['width'] if end is None else max(0, end - entry['first_year'] + 1)
+        return lo, min(hi, entry['width'])
+
+    def available(self, indicator, countries, start=None, end=None):
+        '''
+        Return a bool array, for each country name in `countries`,
+        of whether it has any value between `start` and `end` inclusive.
+        '''
+        result = np.zeros(len(countries), dtype=bool)
+        entry = self.entries.get(indicator)
+        if entry is None:
+            return result
+        rows = self._rows(entry, countries)
+        found = rows >= 0
+        lo, hi = self._window(entry, start, end)
+        if found.any() and lo < hi:
+            bits = np.unpackbits(entry['bits'][rows[found]], axis=1)[:, lo:hi]
+            result[found] = bits.any(axis=1)
+        return result
+
+    def empty_facets(self, indicator, countries, start=None, end=None):
+        '''The names in `countries` without a value in the year range.'''
+        available = self.available(indicator, countries, start, end)
+        return [c for c, a in zip(countries, available) if not a]
+
+    def latest_year(self, indicator, countries=None):
+        '''Dict of country name -> last year with a value.'''
+        entry = self.entries.get(indicator)
+        if entry is None:
+            return {}
+        names = [self.countries.get(int(cid)) for cid in entry['country_ids']]
+        latest = dict(zip(names, entry['last'].tolist()))
+        if countries is not None:
+            latest = dict((c, latest[c]) for c in countries if c in latest)
+        return latest
+
+    def extents(self, indicator, countries=None, start=None, end=None):
+        '''
+        Return the xmin, xmax, ymin and ymax of the given countries
+        (all if None) between `start` and `end`, as plot axis limits;
+        None where there is no data. Years are exact. Values are only
+        known per whole series, so ymin and ymax are None as well when
+        the range cuts the series of a country with data in it.
+        '''
+        extents = dict.fromkeys(['xmin', 'xmax', 'ymin', 'ymax'])
+        entry = self.entries.get(indicator)
+        if entry is None:
+            return extents
+        if countries is None:
+            rows = np.arange(len(entry['country_ids']))
+        else:
+            rows = self._rows(entry, countries)
+            rows = rows[rows >= 0]
+        lo, hi = self._window(entry, start, end)
+        if not len(rows) or lo >= hi:
+            return extents
+        bits = np.unpackbits(entry['bits'][rows], axis=1)[:, lo:hi].astype(bool)
+        rows = rows[bits.any(axis=1)]
+        columns = np.flatnonzero(bits.any(axis=0))
+        if not len(rows):
+            return extents
+        extents.update(xmin=entry['first_year'] + lo + int(columns[0]),
+                       xmax=entry['first_year'] + lo + int(columns[-1]))
+        cut = ((start is not None and (entry['first'][rows] < start).any())
+               or (end is not None and (entry['last'][rows] > end).any()))
+        if not cut:
+            extents.update(ymin=entry['vmin'][rows].min(),
+                           ymax=entry['vmax'][rows].max())
+        return extents
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Dense country x year arrays per indicator.
+
+A Cube holds each indicator as a float array shaped
+(countries, years), NaN where there is no value. All arrays share
+one country axis, the HFAIndex country ids in ascending order, and
+one year axis covering every year in the data, so cross-country
+and cross-indicator questions become plain array operations:
+
+    cube = Cube(DataImporter().series, HFAIndex())
+    gdp = cube['0260']                       # (countries, years)
+    cube.rank('0260')[:, cube.year_pos(2010)]
+    values, years = cube.latest('1320')
+
+Arrays are built from the store on first use. Cube.query() answers
+in the same format as SeriesIndex.query(), so a Cube can be passed
+to Plot in place of the SeriesIndex.
+"""
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from hfa.store import empty_frame, long_frame, year_window
+
+
+class Cube(object):
+    '''
+    Dense per-indicator arrays on shared country and year axes.
+
+    Parameters
+    ----------
+    series: hfa.series.SeriesIndex
+       Source of the sorted per-indicator columns.
+    index: hfa.indices.HFAIndex
+       Defines the country axis and resolves indicator ids.
+
+    Attributes
+    ----------
+    country_ids: list of unicode
+       The country axis: HFAIndex ids, plus any ids only in the data.
+    years: int array
+       The year axis, every year from the first to the last in the data.
+    '''
+
+    def __init__(self, series, index):
+        self.series = series
+        self.index = index
+        ids = set(index.records['countries'])
+        ids.update(u'{:04d}'.format(cid) for cid in series.countries)
+        self.country_ids = sorted(ids)
+        self.rows = dict((idx, row) for row, idx in enumerate(self.country_ids))
+
+        # store country_id -> row on the country axis
+        self._row_of = np.empty(max(int(i) for i in self.country_ids) + 1,
+                                dtype=np.intp)
+        self._row_of.fill(-1)
+        for idx, row in self.rows.items():
+            self._row_of[int(idx)] = row
+
+        first, last = None, None
+        for indicator in series.indicators:
+            year = series.columns(indicator)['year']
+            if len(year):
+                first = min(first, year.min()) if first is not None else year.min()
+                last = max(last, year.max()) if last is not None else year.max()
+        if first is None:
+            self.years = np.array([], dtype=np.int64)
+        else:
+            self.years = np.arange(int(first), int(last) + 1, dtype=np.int64)
+        self._arrays = {}
+
+    @property
+    def shape(self):
+        return len(self.country_ids), len(self.years)
+
+    def name(self, indicator):
+        '''English name of an indicator given by id or name.'''
+        if indicator in self.series:
+            return indicator
+        name = self.index.get_name(indicator)
+        if name is None or name not in self.series:
+            raise KeyError('No data for indicator {!r}'.format(indicator))
+        return name
+
+    def array(self, indicator):
+        '''
+        Return the (countries, years) array of an indicator given by
+        id or English name. The array is shared: copy before changing it.
+        '''
+        name = self.name(indicator)
+        if name not in self._arrays:
+            part = self.series.columns(name)
+            values = np.empty(self.shape)
+            values.fill(np.nan)
+            rows = self._row_of[np.asarray(part['country_id'], dtype=np.intp)]
+            cols = np.asarray(part['year'], dtype=np.intp) - self.years[0]
+            values[rows, cols] = part['value']
+            self._arrays[name] = values
+        return self._arrays[name]
+
+    __getitem__ = array
+
+    def country_pos(self, idx):
+        return self.rows[unicode(idx)]
+
+    def year_pos(self, year):
+        pos = int(year) - int(self.years[0])
+        if not 0 <= pos < len(self.years):
+            raise KeyError('Year {} outside {}-{}'.format(
+                year, self.years[0], self.years[-1]))
+        return pos
+
+    def rank(self, indicator, ascending=False):
+        '''
+        Rank the countries in every year: 1 is the highest value, or
+        the lowest if `ascending`. Ties keep the country axis order;
+        missing values get NaN.
+        '''
+        values = self.array(indicator)
+        order = np.argsort(values if ascending else -values, axis=0,
+                           kind='mergesort')  # NaN sorts last
+        ranks = np.empty(values.shape)
+        ranks[order, np.arange(values.shape[1])] = \
+            np.arange(1, values.shape[0] + 1)[:, np.newaxis]
+        ranks[np.isnan(values)] = np.nan
+        return ranks
+
+    def change(self, indicator, periods=1, relative=False):
+        '''
+        Return the change over `periods` years for every country and
+        year, as a fraction of the earlier value if `relative`. The
+        first `periods` years, and years without both values, are NaN.
+        '''
+        values = self.array(indicator)
+        result = np.empty(values.shape)
+        result.fill(np.nan)
+        if periods < values.shape[1]:
+            later, earlier = values[:, periods:], values[:, :-periods]
+            diff = later - earlier
+            if relative:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    diff = diff / earlier
+            result[:, periods:] = diff
+        return result
+
+    def latest(self, indicator, end=None):
+        '''
+        Return the last available value of each country up to the
+        year `end` (inclusive, default the last year), and the year
+        it refers to. Both are NaN for countries without a value.
+        '''
+        values = self.array(indicator)
+        if end is not None:
+            values = values[:, :max(0, int(end) - int(self.years[0]) + 1)]
+        latest = np.empty(values.shape[0])
+        latest.fill(np.nan)
+        years = latest.copy()
+        if not values.shape[1]:
+            return latest, years
+        present = ~np.isnan(values)
+        last = values.shape[1] - 1 - np.argmax(present[:, ::-1], axis=1)
+        rows = np.flatnonzero(present.any(axis=1))
+        latest[rows] = values[rows, last[rows]]
+        years[rows] = self.years[last[rows]]
+        return latest, years
+
+    def frame(self, indicator, lang=None):
+        '''
+        Return an indicator as a wide DataFrame of countries x years,
+        indexed by country id, or by name if `lang` is 'en' or 'ru'.
+        Countries without any value are left out.
+        '''
+        values = self.array(indicator)
+        keep = ~np.isnan(values).all(axis=1)
+        labels = [idx for idx, k in zip(self.country_ids, keep) if k]
+        if lang:
+            labels = [self.index.get_name(idx, lang, 'countries') or idx
+                      for idx in labels]
+        return pd.DataFrame(values[keep], index=labels, columns=self.years)
+
+    def query(self, indicator, countries, start=None, end=None):
+        '''
+        As SeriesIndex.query: the long-format rows of one indicator for
+        the given countries (English names) and inclusive year range,
+        sorted by year.
+        '''
+        if indicator not in self.series or not len(self.years):
+            return empty_frame()
+        values = self.array(indicator)
+        lo, hi = year_window(self.years, start, end)
+        cids, rows = [], []
+        for country in OrderedDict.fromkeys(countries):  # each once
+            cid = self.series.country_ids.get(country)
+            if cid is not None:
+                cids.append(cid)
+                rows.append(self._row_of[cid])
+        if not rows:
+            return empty_frame()
+        labels = [self.series.countries[cid] for cid in cids]
+        return long_frame(cids, labels, self.years[lo:hi],
+                          values[rows, lo:hi], indicator)
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+Derived indicators given as expressions over stored indicators.
+
+    rolling(1320, 3)             trailing 3-year mean
+    pct_change(0260)             annual % change (pct_change(0260, 5): 5-year)
+    rebase(0260, 2000)           index, 2000 = 100
+    relative(1320, European Region)
+                                 ratio to a reference country or group
+                                 mean such as mean(eu), reference = 100
+
+Indicators are given by id or English name and expressions nest, e.g.
+rolling(pct_change(0260), 3). Such an expression can be used as the
+`indicator` of a plot spec or passed to DerivedIndicators.query().
+
+Nothing is computed until an expression is queried. It is then
+evaluated for all countries at once on the dense arrays of a
+hfa.cube.Cube and memoized per (expression, data version), so charts
+sharing a derived series compute it once.
+"""
+import re
+from collections import OrderedDict
+
+import numpy as np
+
+from hfa.cube import Cube
+from hfa.store import empty_frame, long_frame, year_window
+
+CALL = re.compile(r'^\s*(\w+)\s*\((.*)\)\s*$')
+
+# function name -> English and Russian label templates
+FUNCTIONS = {
+    'rolling': (u'{0}, {1}-year rolling mean',
+                u'{0}, скользящее среднее за {1} г.'),
+    'pct_change': (u'{0}, % change over {1} year(s)',
+                   u'{0}, изменение за {1} г., %'),
+    'rebase': (u'{0}, index ({1} = 100)',
+               u'{0}, индекс ({1} = 100)'),
+    'relative': (u'{0}, relative to {1} (= 100)',
+                 u'{0}, по отношению к {1} (= 100)'),
+}
+ANNUAL_CHANGE = (u'{0}, annual % change', u'{0}, годовое изменение, %')
+
+
+def is_expression(indicator):
+    '''True if `indicator` is a derived-indicator expression.'''
+    if not isinstance(indicator, basestring):
+        return False
+    match = CALL.match(indicator)
+    return match is not None and match.group(1) in FUNCTIONS
+
+
+def _split_last(text):
+    '''Split at the last comma outside parentheses; English names may
+    themselves contain commas.'''
+    depth = 0
+    for i in range(len(text) - 1, -1, -1):
+        if text[i] == ')':
+            depth += 1
+        elif text[i] == '(':
+            depth -= 1
+        elif text[i] == ',' and depth == 0:
+            return text[:i].strip(), text[i + 1:].strip()
+    return text.strip(), None
+
+
+def _int(value, what, expression):
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError('{} must be a whole number in {!r}'.format(what, expression))
+
+
+def parse(expression, index):
+    '''
+    Parse an expression into nested tuples:
+
+        ('indicator', English name)
+        ('rolling', node, window)
+        ('pct_change', node, periods)
+        ('rebase', node, year)
+        ('relative', node, reference label)
+
+    Raises ValueError for malformed expressions and unknown indicators.
+    '''
+    expression = expression.strip()
+    match = CALL.match(expression)
+    if match is None or match.group(1) not in FUNCTIONS:
+        name = index.get_name(expression)
+        if name is None and index.get_id(expression) is not None:
+            name = expression
+        if name is None:
+            raise ValueError('Unknown indicator {!r}'.format(expression))
+        return ('indicator', name)
+
+    func = match.group(1)
+    head, tail = _split_last(match.group(2))
+    if func == 'pct_change' and not (tail or '').isdigit():
+        head, tail = match.group(2).strip(), '1'
+    if not head or not tail:
+        raise ValueError('{}() takes an indicator and one argument: {!r}'.format(
+            func, expression))
+    node = parse(head, index)
+    if func == 'relative':
+        return (func, node, tail)
+    value = _int(tail, 'the second argument', expression)
+    if func in ('rolling', 'pct_change') and value < 1:
+        raise ValueError('{}() needs a positive number of years'.format(func))
+    return (func, node, value)
+
+
+def dependencies(node):
+    '''
+    Return the set of English indicator names and the set of
+    reference labels (of relative()) that a parsed node reads.
+    '''
+    if node[0] == 'indicator':
+        return set([node[1]]), set()
+    indicators, labels = dependencies(node[1])
+    if node[0] == 'relative':
+        labels.add(node[2])
+    return indicators, labels
+
+
+def canonical(node, index):
+    '''The expression of a parsed node in a normal form, by indicator id.'''
+    if node[0] == 'indicator':
+        return index.get_id(node[1]) or node[1]
+    return u'{}({}, {})'.format(node[0], canonical(node[1], index), node[2])
+
+
+def describe(expression, index, lang='en'):
+    '''Human-readable title of an expression in `lang`.'''
+    return _describe(parse(expression, index), index, lang)
+
+
+def _describe(node, index, lang):
+    if node[0] == 'indicator':
+        return index.get_name(index.get_id(node[1]), lang) or node[1]
+    templates = FUNCTIONS[node[0]]
+    if node[0] == 'pct_change' and node[2] == 1:
+        templates = ANNUAL_CHANGE
+    template = templates[0 if lang == 'en' else 1]
+    argument = node[2]
+    if node[0] == 'relative':
+        idx = index.get_id(argument, 'countries')
+        argument = index.get_name(idx, lang, 'countries') if idx else argument
+    return template.format(_describe(node[1], index, lang), argument)
+
+
+def rolling(values, window):
+    '''Trailing mean over `window` years; NaN unless all are present.'''
+    present = ~np.isnan(values)
+    zeros = np.zeros((values.shape[0], 1))
+    total = np.hstack([zeros, np.cumsum(np.where(present, values, 0), axis=1)])
+    count = np.hstack([zeros, np.cumsum(present, axis=1)])
+    result = np.empty(values.shape)
+    result.fill(np.nan)
+    if window <= values.shape[1]:
+        sums = total[:, window:] - total[:, :-window]
+        full = (count[:, window:] - count[:, :-window]) == window
+        result[:, window - 1:] = np.where(full, sums / window, np.nan)
+    return result
+
+
+def pct_change(values, periods):
+    '''% change against the value `periods` years earlier.'''
+    result = np.empty(values.shape)
+    result.fill(np.nan)
+    if periods < values.shape[1]:
+        earlier = values[:, :-periods]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result[:, periods:] = (values[:, periods:] - earlier) / earlier * 100
+    return result
+
+
+def rebase(values, pos):
+    '''Index each row on its value at column `pos` (= 100).'''
+    if pos is None:
+        result = np.empty(values.shape)
+        result.fill(np.nan)
+        return result
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return values / values[:, pos:pos + 1] * 100
+
+
+def relative(values, reference):
+    '''Ratio of each row to a reference row (= 100).'''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return values / reference * 100
+
+
+class DerivedIndicators(object):
+    '''
+    Answer query() for stored and derived indicators alike.
+
+    Parameters
+    ----------
+    source: object with a query() method
+       hfa.series.SeriesIndex or hfa.aggregate.Aggregator; plain
+       indicators are passed through to it.
+    index: hfa.indices.HFAIndex
+    '''
+
+    def __init__(self, source, index):
+        self.source = source
+        self.index = index
+        self._cube = None
+        self._memo = {}
+
+    def __getattr__(self, name):
+        # Stand in for the source everywhere else
+        if name.startswith('_') or name == 'source':
+            raise AttributeError(name)
+        return getattr(self.source, name)
+
+    def __contains__(self, indicator):
+        return is_expression(indicator) or indicator in self.source
+
+    @property
+    def cube(self):
+        if self._cube is None:
+            self._cube = Cube(self.source, self.index)
+        return self._cube
+
+    def evaluate(self, expression, label=None):
+        '''
+        Return the values of an expression on the cube's year axis:
+        a (countries, years) array for all countries, or a (1, years)
+        array for one country or group `label`.
+        '''
+        node = parse(expression, self.index)
+        return self._evaluate(node, label)
+
+    def _evaluate(self, node, label):
+        key = (canonical(node, self.index), label,
+               getattr(self.source, 'version', None))
+        if key in self._memo:
+            return self._memo[key]
+        func = node[0]
+        if func == 'indicator':
+            result = self._leaf(node[1], label)
+        else:
+            values = self._evaluate(node[1], label)
+            if func == 'rolling':
+                result = rolling(values, node[2])
+            elif func == 'pct_change':
+                result = pct_change(values, node[2])
+            elif func == 'rebase':
+                years = self.cube.years
+                pos = node[2] - years[0] if len(years) else None
+                result = rebase(values, pos if 0 <= pos < len(years) else None)
+            else:
+                result = relative(values, self._evaluate(node[1], node[2]))
+        self._memo[key] = result
+        return result
+
+    def _leaf(self, name, label):
+        years = self.cube.years
+        if name not in self.source:
+            # an indexed indicator without data has no values anywhere
+            block = np.empty((self.cube.shape[0] if label is None else 1,
+                              len(years)))
+            block.fill(np.nan)
+            return block
+        if label is None:
+            return self.cube.array(name)
+        row = np.empty((1, len(years)))
+        row.fill(np.nan)
+        data = self.source.query(name, [label])
+        pos = np.asarray(data['year'], dtype=np.intp) - (years[0] if len(years) else 0)
+        inside = (pos >= 0) & (pos < len(years))
+        row[0, pos[inside]] = np.asarray(data['value'])[inside]
+        return row
+
+    def query(self, indicator, countries, start=None, end=None):
+        '''
+        As SeriesIndex.query, where `indicator` may also be an
+        expression; its rows then carry the expression as indicator.
+        '''
+        if not is_expression(indicator):
+            return self.source.query(indicator, countries, start, end)
+        years = self.cube.years
+        if not len(years):
+            return empty_frame()
+        lo, hi = year_window(years, start, end)
+
+        node = parse(indicator, self.index)
+        country_ids = self.source.country_ids
+        cids, labels, rows = [], [], []
+        for country in OrderedDict.fromkeys(countries):  # each once
+            if country is None:
+                continue
+            cid = country_ids.get(country)
+            if cid is not None:
+                row = self._evaluate(node, None)[
+                    self.cube.country_pos(u'{:04d}'.format(cid))]
+            else:
+                cid = -1  # as hfa.aggregate.AGGREGATE_ID
+                row = self._evaluate(node, country)[0]
+            cids.append(cid)
+            labels.append(country)
+            rows.append(row[lo:hi])
+        if not rows:
+            return empty_frame()
+        return long_frame(cids, labels, years[lo:hi], np.vstack(rows), indicator)
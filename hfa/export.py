@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+Export every indicator as a wide table of countries x years.
+
+Indicators are exported one at a time straight from their store
+partition, so memory use is bounded by the largest single indicator
+rather than the whole database. CSV files are written in chunks of
+rows; the npz format holds the same table as NumPy arrays
+(country_id, year, value matrix). Each file is named after the
+indicator id and written atomically.
+
+When run as a main module:
+
+    python -m hfa.export --format csv --labels ru --processes 4 [ids...]
+"""
+from __future__ import print_function
+import argparse
+import csv
+import multiprocessing
+import os
+import re
+import time
+
+import numpy as np
+
+from hfa.importer import DataImporter
+from hfa.indices import HFAIndex
+from hfa.store import ColumnarStore, replace_file
+
+EXPORT_DIR = 'export'
+FORMATS = ('csv', 'npz')
+CHUNK_ROWS = 256
+
+
+def wide_table(part):
+    '''
+    Pivot the columns of one partition into a dense table.
+
+    Returns
+    ----------
+    country_ids: int array of the table rows, ascending
+    years: int array of the table columns, ascending
+    values: float array of shape (countries, years), NaN where missing
+    '''
+    cid = np.asarray(part['country_id'])
+    year = np.asarray(part['year'])
+    if not len(year):
+        return (np.array([], dtype=np.int64), np.array([], dtype=np.int64),
+                np.empty((0, 0)))
+    # rows are sorted by (country_id, year): countries come out in order
+    country_ids, rows = np.unique(cid, return_inverse=True)
+    first, last = int(year.min()), int(year.max())
+    values = np.empty((len(country_ids), last - first + 1))
+    values.fill(np.nan)
+    values[rows, year - first] = part['value']
+    return (country_ids.astype(np.int64),
+            np.arange(first, last + 1, dtype=np.int64),
+            values)
+
+
+def file_stub(indicator, idx):
+    '''File name stem for an indicator: its id, else its sanitised name.'''
+    if idx:
+        return idx
+    return re.sub(r'[^\w]+', '_', indicator).strip('_')
+
+
+def write_csv(path, country_ids, years, values, names=None):
+    '''Write a wide table as CSV, CHUNK_ROWS rows at a time.'''
+    header = ['country_id'] + (['country'] if names is not None else [])
+    with open(path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(header + [str(y) for y in years])
+        for start in range(0, len(country_ids), CHUNK_ROWS):
+            chunk = []
+            for i in range(start, min(start + CHUNK_ROWS, len(country_ids))):
+                row = ['{:04d}'.format(country_ids[i])]
+                if names is not None:
+                    name = names.get(country_ids[i], u'')
+                    row.append(name.encode('utf-8')
+                               if isinstance(name, unicode) else name)
+                row.extend('' if np.isnan(v) else repr(v) for v in values[i])
+                chunk.append(row)
+            writer.writerows(chunk)
+
+
+def write_npz(path, country_ids, years, values, names=None):
+    '''Write a wide table as compressed NumPy arrays.'''
+    arrays = {'country_id': country_ids, 'year': years, 'value': values}
+    if names is not None:
+        arrays['country'] = np.array([names.get(c, u'') for c in country_ids],
+                                     dtype=object).astype(unicode)
+    with open(path, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+
+
+WRITERS = {'csv': write_csv, 'npz': write_npz}
+
+
+def export_indicator(task):
+    '''
+    Export one indicator; runs in the pool workers.
+
+    Parameters
+    ----------
+    task: tuple
+       (store_dir, indicator, path, fmt, names) where `names` is a
+       dict of country_id -> label, or None for no labels.
+
+    Returns
+    ----------
+    (indicator, path, countries, years, seconds)
+    '''
+    store_dir, indicator, path, fmt, names = task
+    start = time.time()
+    store = _open_store(store_dir)
+    country_ids, years, values = wide_table(store.partition(indicator))
+    tmp = path + '.tmp'
+    WRITERS[fmt](tmp, country_ids, years, values, names)
+    replace_file(tmp, path)
+    store.release(indicator)
+    return indicator, path, len(country_ids), len(years), time.time() - start
+
+
+_STORES = {}
+
+
+def _open_store(store_dir):
+    # one store (and its manifest) per process
+    if store_dir not in _STORES:
+        _STORES[store_dir] = ColumnarStore(store_dir)
+    return _STORES[store_dir]
+
+
+def export_all(out_dir=EXPORT_DIR, fmt='csv', labels=None, ids=None,
+               processes=None, importer=None, index=None):
+    '''
+    Export indicators from the DataImporter store into `out_dir`.
+
+    Parameters
+    ----------
+    out_dir: string (optional)
+       Directory of the exported files, created if needed.
+    fmt: string (optional)
+       'csv' or 'npz'.
+    labels: string (optional)
+       'en' or 'ru' adds a column of country names in that language.
+    ids: list of strings (optional)
+       Indicator ids to export; all indicators in the store if empty.
+    processes: int (optional)
+       Size of the process pool; 1 exports in this process.
+
+    Returns
+    ----------
+    The list of paths written.
+    '''
+    if fmt not in WRITERS:
+        raise ValueError('Unknown export format {!r}, use one of {}'.format(
+            fmt, ', '.join(FORMATS)))
+    importer = importer or DataImporter()
+    index = index or HFAIndex()
+    store = importer.store
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    names = None
+    if labels:
+        names = {}
+        for cid, name in store.countries.items():
+            idx = index.get_id(name, 'countries')
+            names[cid] = index.get_name(idx, labels, 'countries') if idx else name
+
+    indicators = store.indicators
+    if ids:
+        wanted = [index.get_name(idx) for idx in ids]
+        missing = [idx for idx, name in zip(ids, wanted) if name not in store]
+        if missing:
+            raise ValueError('No data for indicators {}'.format(', '.join(missing)))
+        indicators = wanted
+    tasks = [(store.store_dir, indicator,
+              os.path.join(out_dir, '{}.{}'.format(
+                  file_stub(indicator, index.get_id(indicator)), fmt)),
+              fmt, names)
+             for indicator in indicators]
+
+    processes = min(processes or multiprocessing.cpu_count(), len(tasks))
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = list(pool.imap_unordered(export_indicator, tasks))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [export_indicator(task) for task in tasks]
+    for indicator, path, countries, years, seconds in results:
+        print('Exported {} ({} countries x {} years) in {:.2f}s'.format(
+            path, countries, years, seconds))
+    return [task[2] for task in tasks]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Export indicators as wide country x year tables.')
+    parser.add_argument('ids', nargs='*', help='indicator ids (default all)')
+    parser.add_argument('-o', '--output', default=EXPORT_DIR,
+                        help='output directory (default ./export)')
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--labels', choices=['en', 'ru'],
+                        help='add country names in this language')
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help='export process pool size (default: CPU count)')
+    args = parser.parse_args()
+    try:
+        export_all(args.output, args.format, args.labels, args.ids,
+                   args.processes)
+    except ValueError as e:
+        parser.error(str(e))
+
+
+if __name__ == '__main__':
+    main()
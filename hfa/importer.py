@@ -5,15 +5,28 @@ Created on Sun Oct 20 20:10:29 2013
 @author: gauden
 """
 
+from __future__ import print_function
 import os
 import glob
+import time
+import HTMLParser
+import multiprocessing
+from array import array
+from htmlentitydefs import name2codepoint
+
+import numpy as np
 import pandas as pd
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, UnicodeDammit
 from StringIO import StringIO
 
+from hfa import trace
+from hfa.coverage import Coverage
+from hfa.series import SeriesIndex
+from hfa.store import ColumnarStore, migrate_pickle
+
 
 class DataImporter(object):
-    '''Load the default dataframe stroed as a pickled Pandas DatFrame.
+    '''Open the default columnar store of HFA data (see hfa.store).
     Also augment it with any new data found as HTML table files in 
     the raw data directory. The HTML should be in the HFA Table A format.
 
@@ -22,24 +35,45 @@ class DataImporter(object):
     raw_data_dir: string (optional)
        Path to a raw data directory, defaults to ./data/raw otherwise.
        Looks for any new HTML files in this directory for new data to import.
+    store_dir: string (optional)
+       Path to the columnar store, defaults to ./data/store otherwise.
+       If the store does not exist yet but the legacy pickle
+       ./data/master_frame.pkl does, the pickle is migrated once.
+    processes: int (optional)
+       Size of the process pool used to parse raw files, defaults to
+       the number of CPUs. 1 parses in the current process.
     
     Data
     -------
+    store: hfa.store.ColumnarStore
+       The memory-mapped store; partitions are only read when used
     DF: Pandas DataFrame
        A property containing all the HFA data currently 
-       stored in the package
+       stored in the package, materialised on first access
+    series: hfa.series.SeriesIndex
+       A property indexing the store by (indicator, country, year)
+    coverage: hfa.coverage.Coverage
+       A property telling which countries and years have data,
+       kept up to date by every import
+    timings: dict
+       Seconds spent in the parse, merge and save stages of the last
+       bulk import, empty if nothing was imported
        
     '''
     
-    def __init__(self, raw_data_dir=None):
+    def __init__(self, raw_data_dir=None, store_dir=None, processes=None):
         self.DATA_DIR = os.path.join('.', 'data')
         self.DATA_PKL = os.path.join(self.DATA_DIR, 'master_frame.pkl')
+        self.STORE_DIR = store_dir or os.path.join(self.DATA_DIR, 'store')
+        self._df = None
+        self._series = None
+        self._coverage = None
+        self.timings = {}
 
-        # Load in the default pickled DataFrame or create a new one
-        try:
-            self.DF = pd.read_pickle(self.DATA_PKL)
-        except IOError:
-            self.DF = pd.DataFrame()
+        # Open the columnar store, migrating the legacy pickle if needed
+        self.store = ColumnarStore(self.STORE_DIR)
+        if not self.store.exists and os.path.exists(self.DATA_PKL):
+            self.store = migrate_pickle(self.DATA_PKL, self.STORE_DIR)
         
         # Seek out any new files from the raw data directory
         if raw_data_dir:
@@ -47,14 +81,104 @@ class DataImporter(object):
         else:
             self.RAW_DATA_DIR = os.path.join(self.DATA_DIR, 'raw')
 
+        self.import_raw(processes)
+
+    def import_raw(self, processes=None):
+        '''Import any files waiting in the raw data directory, removing
+        them once they are in the store. Returns the DataFrame of new
+        rows, or None if there were no files.'''
         files = self.get_file_list()
-        if files:
-            for f in files:
-                new_df = self.get_dataframe(f)
-                self.DF = pd.concat([self.DF, new_df])
-            self.DF.to_pickle(self.DATA_PKL) # save the new master dataframe
-            for f in files:
-                os.remove(f)
+        if not files:
+            return None
+        with trace.span('import.raw', files=len(files)):
+            new_df = self.bulk_import(files, processes)
+        for f in files:
+            os.remove(f) # only once the store has been committed
+        return new_df
+
+    def bulk_import(self, files, processes=None):
+        '''Parse `files` across a process pool, merge them once and
+        append them to the store as one new segment.
+
+        Files are merged in sorted order and deduplicated on
+        (country_id, indicator, year), so a later file wins. Returns
+        the merged DataFrame of new rows.'''
+        
+        files = sorted(files)
+        start = time.time()
+        processes = min(processes or multiprocessing.cpu_count(), len(files))
+        if processes > 1:
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = self._collect(pool.imap_unordered(parse_file, files),
+                                        len(files))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = self._collect((parse_file(f) for f in files), len(files))
+        parsed = time.time()
+
+        new_df = pd.concat([results[f] for f in files], ignore_index=True)
+        new_df = new_df.drop_duplicates(['country_id', 'indicator', 'year'],
+                                        keep='last')
+        merged = time.time()
+
+        before = self.store.version
+        self.store.append(new_df) # a new segment; the base is untouched
+        self._df = self._series = None
+        self._coverage = Coverage.refresh(self.store, set(new_df['indicator']),
+                                          before)
+        saved = time.time()
+        self.timings = {'parse': parsed - start,
+                        'merge': merged - parsed,
+                        'save': saved - merged}
+        print('Imported {} rows from {} files: parse {parse:.2f}s, '
+              'merge {merge:.2f}s, save {save:.2f}s'.format(len(new_df),
+                                                           len(files),
+                                                           **self.timings))
+        return new_df
+
+    def compact(self):
+        '''Fold the segments appended by earlier imports into the base store.'''
+        
+        before = self.store.version
+        self.store.compact()
+        self._df = self._series = None
+        self._coverage = Coverage.refresh(self.store, [], before)
+
+    def _collect(self, results, total):
+        frames = {}
+        for done, (filename, df, seconds) in enumerate(results, 1):
+            frames[filename] = df
+            print('[{}/{}] {}: {} rows in {:.2f}s'.format(done, total, filename,
+                                                         len(df), seconds))
+        return frames
+
+    @property
+    def DF(self):
+        if self._df is None:
+            self._df = self.store.to_frame()
+        return self._df
+
+    @property
+    def series(self):
+        '''A hfa.series.SeriesIndex over the store for indexed lookups.'''
+        if self._series is None:
+            self._series = SeriesIndex.from_store(self.store)
+        return self._series
+
+    @property
+    def coverage(self):
+        '''A hfa.coverage.Coverage of the store, read without the data.'''
+        if self._coverage is None:
+            self._coverage = Coverage.load(self.store)
+        return self._coverage
+
+    def select(self, indicators=None, countries=None):
+        '''Return a hfa.series.SeriesIndex over only the given English
+        indicator and country names; see SeriesIndex.from_store.'''
+        return SeriesIndex.from_store(self.store, indicators, countries)
 
     def get_file_list(self):
         '''Glob a list of html files given the path to a data directory.
@@ -102,8 +226,160 @@ class DataImporter(object):
         return df
     
     def get_dataframe(self, filename):
-        '''Given a pathname to an HTML table file, return a Pandas DataFrame.'''
+        '''Given a pathname to an HTML table file, return a Pandas DataFrame.
+        
+        The file is streamed through TableAParser; the result is identical
+        to get_df_from_text(get_text_from_html(filename)).'''
+        
+        return parse_table_a(filename)
+
+
+def parse_table_a(filename):
+    '''Stream an HFA 'Table A' HTML file into a long DataFrame.'''
+    
+    with open(filename, 'rb') as f:
+        markup = UnicodeDammit(f.read(), is_html=True).unicode_markup
+    parser = TableAParser()
+    parser.feed(markup)
+    parser.close()
+    return parser.get_dataframe()
+
+
+def parse_file(filename):
+    '''Process pool worker: return (filename, DataFrame, seconds taken).'''
+    
+    start = time.time()
+    df = parse_table_a(filename)
+    return filename, df, time.time() - start
+
+
+class TableAParser(HTMLParser.HTMLParser):
+    '''Streaming parser for the first table of an HFA 'Table A' page.
+
+    Row 0 holds the indicator name, row 1 the years, and every further
+    row a '<country_id> <country>' cell followed by one value per year.
+    Values are collected straight into typed arrays; no DOM or 
+    intermediate text table is built. Names are kept as UTF-8 byte
+    strings, as read_table returns them.
+    '''
+
+    # Strings read_table treats as missing, plus the HFA placeholder
+    NA_VALUES = frozenset(['', '...', '#N/A', '#N/A N/A', '#NA', '-1.#IND',
+                           '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+                           'N/A', 'NA', 'NULL', 'NaN', 'n/a', 'nan', 'null'])
+
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.indicator = None
+        self.years = []
+        self.country_ids = array('l')
+        self.countries = []
+        self.rows = array('l')
+        self.cols = array('l')
+        self.values = array('d')
+
+        self._depth = 0     # nesting depth inside the first table
+        self._done = False
+        self._row_count = 0
+        self._row = None    # text pieces of the current <tr>
+        self._cells = None  # finished cell texts of the current <tr>
+        self._cell = None   # text pieces of the current <td>
+
+    def handle_starttag(self, tag, attrs):
+        if self._done:
+            return
+        if tag == 'table':
+            self._depth += 1
+        elif self._depth and tag == 'tr':
+            self._end_row()
+            self._row, self._cells = [], []
+        elif self._depth and tag == 'td' and self._row is not None:
+            self._end_cell()
+            self._cell = []
+
+    def handle_endtag(self, tag):
+        if self._done or not self._depth:
+            return
+        if tag == 'td':
+            self._end_cell()
+        elif tag == 'tr':
+            self._end_row()
+        elif tag == 'table':
+            self._depth -= 1
+            if not self._depth:
+                self._end_row()
+                self._done = True
+
+    def handle_data(self, data):
+        if self._row is not None:
+            self._row.append(data)
+            if self._cell is not None:
+                self._cell.append(data)
+
+    def handle_entityref(self, name):
+        if name in name2codepoint:
+            self.handle_data(unichr(name2codepoint[name]))
+        else:
+            self.handle_data(u'&' + name)
+
+    def handle_charref(self, name):
+        if name[:1] in ('x', 'X'):
+            self.handle_data(unichr(int(name[1:], 16)))
+        else:
+            self.handle_data(unichr(int(name)))
+
+    def _end_cell(self):
+        if self._cell is not None:
+            self._cells.append(u''.join(self._cell))
+            self._cell = None
+
+    def _end_row(self):
+        if self._row is None:
+            return
+        self._end_cell()
+        row, cells = self._row, self._cells
+        self._row = self._cells = None
+
+        if self._row_count == 0:
+            self.indicator = u''.join(row).encode('utf-8')
+        elif self._row_count == 1:
+            self.years = [int(year) for year in cells[1:]]
+        else:
+            country_id, country = cells[0].split(' ', 1)
+            self.country_ids.append(int(country_id))
+            self.countries.append(country.encode('utf-8'))
+            r = self._row_count - 2
+            for c, cell in enumerate(cells[1:len(self.years) + 1]):
+                cell = cell.strip()
+                if cell in self.NA_VALUES:
+                    continue
+                self.values.append(float(cell))
+                self.rows.append(r)
+                self.cols.append(c)
+        self._row_count += 1
+
+    def get_dataframe(self):
+        '''Return the parsed cells as a long DataFrame in the row order 
+        and index that melting the year columns would produce.'''
         
-        text_table = self.get_text_from_html(filename)
-        df = self.get_df_from_text(text_table)
+        rows = np.asarray(self.rows, dtype=np.int64)
+        cols = np.asarray(self.cols, dtype=np.int64)
+        values = np.asarray(self.values, dtype=np.float64)
+        position = cols * len(self.countries) + rows
+        order = np.argsort(position, kind='mergesort')
+        rows = rows[order]
+
+        country_ids = np.asarray(self.country_ids, dtype=np.int64)
+        countries = np.empty(len(self.countries), dtype=object)
+        countries[:] = self.countries
+        indicator = np.empty(len(order), dtype=object)
+        indicator.fill(self.indicator)
+        df = pd.DataFrame({'country_id': country_ids[rows],
+                           'country': countries[rows],
+                           'indicator': indicator,
+                           'year': np.array(self.years, dtype=np.int64)[cols[order]],
+                           'value': values[order]},
+                          index=position[order],
+                          columns=['country_id', 'country', 'indicator',
+                                   'year', 'value'])
         return df
\ No newline at end of file
@@ -10,20 +10,62 @@ Created on Sat Nov  9 13:29:42 2013
 """
 
 import codecs
+import cPickle as pickle
+import hashlib
 import os
 import re
 import HTMLParser
-import pandas as pd
+
+from hfa import trace
+from hfa.search import IndicatorSearch, tokenize
 
 
 class HFAIndex(object):
     '''
-    A Pandas DataFrame that containscountry names and indicators
-    in English and Russian languages.
+    The country and indicator names of the HFA database, in English
+    and Russian.
+
+    The parsed records are cached on disk (see Extractor) and held
+    in hash maps of id -> (en, ru) and name -> id per index type,
+    so that lookups by id or by name in either language are O(1).
+    DataFrames of the records (data, frames) are built only when
+    first asked for.
     '''
 
+    INDEX_TYPES = ('countries', 'indicators')
+
     def __init__(self, data_dir=os.path.join('.', 'hfa', 'index_data')):
-        self.data = Extractor(data_dir).data
+        extractor = Extractor(data_dir)
+        self._extractor = extractor
+        self.records = {}
+        self.ids = {}
+        self._frames = None
+        for index_type in self.INDEX_TYPES:
+            records = extractor.records[index_type]
+            self.records[index_type] = dict((idx, (en, ru))
+                                            for idx, en, ru in records)
+            names = {}
+            for idx, en, ru in reversed(records):
+                names[ru] = idx
+                names[en] = idx
+            self.ids[index_type] = names
+        self._records = extractor.records['indicators']
+        self._search = None
+
+    @property
+    def data(self):
+        '''All records as one DataFrame, built on first access.'''
+        return self._extractor.data
+
+    @property
+    def frames(self):
+        '''Index type -> DataFrame of its records, built on first access
+        so that lookups by id or name never import pandas.'''
+        if self._frames is None:
+            self._frames = dict(
+                (index_type, self._frame(self._extractor.records[index_type]))
+                for index_type in self.INDEX_TYPES)
+        return self._frames
 
     def __getitem__(self, item):
         try:
@@ -35,13 +77,22 @@ class HFAIndex(object):
             return None
 
     def get_countries(self, names=[], ids=[], lang=None):
-        # TODO BUG -- can only handle ONE id -- amend the _get_subset() method
         return self.get_subset(names, ids, lang, index_type='countries')
 
     def get_indicators(self, names=[], ids=[], lang=None):
-        # TODO BUG -- can only handle ONE id -- amend the _get_subset() method
         return self.get_subset(names, ids, lang, index_type='indicators')
 
+    def get_id(self, name, index_type='indicators'):
+        '''Return the id of an English or Russian name, or None.'''
+        return self.ids[index_type].get(name)
+
+    def get_name(self, idx, lang='en', index_type='indicators'):
+        '''Return the name of an id in `lang`, or None.'''
+        record = self.records[index_type].get(unicode(idx))
+        if record is None:
+            return None
+        return record[0] if lang == 'en' else record[1]
+
     def get_subset(self,
                    names=[],
                    ids=[],
@@ -61,56 +112,74 @@ class HFAIndex(object):
         lang: string (optional)
            'en' or 'ru' return the English or Russian names respectively.
            If None, return both languages
+
+        Returns
+        ----------
+        A DataFrame indexed by id with 'ru' and 'en' columns, holding the
+        records matched by name followed by those matched by id, or a
+        Series of one language if `lang` is given. Unknown names and
+        ids are skipped.
         '''
-        result = self.data[self.data['index_type'] == index_type]
-        result = result.drop('index_type', 1)
-
-        # collect subsets by name and id
-        if names:
-            result_by_name = result.loc[(result['en'].isin(names)) | (result['ru'].isin(names))]
-        if ids:
-            result_by_id = result.ix[ids]
-
-        # Combine the subsets if these are desired and not empty
-        names_requested = names and result_by_name
-        ids_requested = ids and result_by_id
-        if names_requested and not ids_requested:
-            result = result_by_name
-        elif ids_requested and not names_requested:
-            result = result_by_id
-        elif ids_requested and names_requested:
-            result = pd.merge(result_by_name, result_by_id, how='outer')
+        if not names and not ids:
+            result = self.frames[index_type]
+        else:
+            by_name = self.ids[index_type]
+            wanted = [by_name[name] for name in names if name in by_name]
+            wanted.extend(unicode(idx) for idx in ids)
+            records = self.records[index_type]
+            seen = set()
+            rows = []
+            for idx in wanted:
+                if idx in records and idx not in seen:
+                    seen.add(idx)
+                    en, ru = records[idx]
+                    rows.append((idx, en, ru))
+            result = self._frame(rows)
 
         # return the desired language column alone if this is specified
         if lang:
             result = result[lang]
         return result
 
-    def find_indicators(self, needle):
+    def _frame(self, records):
+        import pandas as pd
+        return pd.DataFrame([(ru, en) for idx, en, ru in records],
+                            index=pd.Index([r[0] for r in records], name='idx'),
+                            columns=['ru', 'en'])
+
+    @property
+    def indicator_search(self):
+        '''The inverted index of indicator names, built on first use.'''
+        if self._search is None:
+            self._search = IndicatorSearch(self._records)
+        return self._search
+
+    def find_indicators(self, needle, limit=None):
         '''
-        Return the record of a particular indicator, or set of indicators
-        that match a given string.
+        Return the records of the indicators that best match a given string.
 
         Parameters
         ----------
         needle: unicode object
-           Names of relevant countries to return.
-           If empty, return all.
+           Words, or beginnings of words, of the English or Russian
+           indicator name, in any case. Misspelt words match similar
+           ones. If empty, return all.
+        limit: int (optional)
+           Return at most this many records.
 
         Returns
         ----------
         indics: pandas DataFrame
-           All records that contain the needle in en or ru cols.
-           
-        '''
+           The matching records in en and ru cols, best match first.
 
-        result = self.data[self.data['index_type'] == 'indicators']
-        result = result.drop('index_type', 1)
-
-        # df[df['A'].str.contains("hello")]
-        result = result.loc[(result['en'].str.contains(needle))
-                            | (result['ru'].str.contains(needle))]
-        return result
+        '''
+        if not tokenize(needle):
+            result = self.frames['indicators']
+            return result[:limit] if limit else result
+        ids = self.indicator_search.ids(needle, limit)
+        if not ids:
+            return self._frame([])
+        return self.get_indicators(ids=ids)
 
 
 class Extractor(object):
@@ -122,14 +191,65 @@ class Extractor(object):
     - raw_indicators_[en/ru].txt and
     - raw_countries_[en/ru].txt
     Parse and extract data, and create Pandas DataFrame.
+
+    The parsed records are pickled to index_cache.pkl in the same
+    directory, keyed by the SHA-1 of the four raw files, so the regex
+    pass only runs again when one of them changes.
     '''
 
     PATTERN = re.compile(r"'\d{4}\s[^']+'")
     H = HTMLParser.HTMLParser()
+    CACHE = 'index_cache.pkl'
+    CACHE_VERSION = 1
 
     def __init__(self, data_dir):
         self.data_dir = data_dir
-        self.data = self.extract_data()
+        self.records = self.load_records()
+        self._data = None
+
+    @property
+    def data(self):
+        '''The records as one DataFrame, built on first access.'''
+        if self._data is None:
+            self._data = self.extract_data()
+        return self._data
+
+    def _raw_file(self, index_type, lang):
+        fn = 'raw_{prefix}_{lang}.txt'.format(prefix=index_type, lang=lang)
+        return os.path.join(self.data_dir, fn)
+
+    def _hashes(self):
+        hashes = {}
+        for fn in [self._raw_file(index_type, lang)
+                   for index_type in ['countries', 'indicators']
+                   for lang in ['ru', 'en']]:
+            with open(fn, 'rb') as f:
+                hashes[os.path.basename(fn)] = hashlib.sha1(f.read()).hexdigest()
+        return hashes
+
+    def load_records(self):
+        '''Return the parsed records, from the cache when it is current.'''
+        cache = os.path.join(self.data_dir, self.CACHE)
+        hashes = self._hashes()
+        try:
+            with open(cache, 'rb') as f:
+                cached = pickle.load(f)
+            if (cached['version'] == self.CACHE_VERSION
+                    and cached['hashes'] == hashes):
+                return cached['records']
+        except (IOError, EOFError, KeyError, TypeError, pickle.PickleError):
+            pass
+
+        with trace.span('index.extract'):
+            records = self.extract_records()
+        try:
+            with open(cache, 'wb') as f:
+                pickle.dump({'version': self.CACHE_VERSION,
+                             'hashes': hashes,
+                             'records': records}, f, pickle.HIGHEST_PROTOCOL)
+        except IOError:
+            pass  # a read-only install simply re-parses every time
+        return records
 
     def _dissect_file(self, fn, index_type):
         records = []
@@ -146,22 +266,28 @@ class Extractor(object):
             records.append((idx, index_type, indicator))
         return records
 
+    def extract_records(self):
+        '''Parse the raw files into {index_type: [(idx, en, ru), ...]},
+        keeping the ids present in both languages in Russian file order.'''
+        results = {}
+        for index_type in ['countries', 'indicators']:
+            english = dict((idx, name) for idx, _, name in self._dissect_file(
+                self._raw_file(index_type, 'en'), index_type))
+            russian = self._dissect_file(self._raw_file(index_type, 'ru'),
+                                         index_type)
+            results[index_type] = [(idx, english[idx], name)
+                                   for idx, _, name in russian
+                                   if idx in english]
+        return results
+
     def extract_data(self):
+        import pandas as pd  # only here, so record lookups stay light
         results = []
         for index_type in ['countries', 'indicators']:
-            data = None
-            for lang in ['ru', 'en']:
-                fn = 'raw_{prefix}_{lang}.txt'.format(prefix=index_type,
-                                                      lang=lang)
-                fn = os.path.join(self.data_dir, fn)
-                records = self._dissect_file(fn, index_type)
-                records = pd.DataFrame.from_records(records[:],
-                                                    columns=['idx', 'index_type', lang])
-                if data:
-                    data = pd.merge(data, records)
-                else:
-                    data = records
-            results.append(data)
+            records = [(idx, index_type, ru, en)
+                       for idx, en, ru in self.records[index_type]]
+            results.append(pd.DataFrame.from_records(
+                records, columns=['idx', 'index_type', 'ru', 'en']))
         df = pd.concat(results)
         df = df.set_index('idx')
         return df
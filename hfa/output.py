@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Batched figure output: rasterize finished figures and encode the
+PNG files in background threads while the next chart is drawn.
+
+    writer = FigureWriter(workers=2, depth=4, compression=6)
+    writer.save(figure, 'img/1320_cis_en.png')   # returns once rasterized
+    ...
+    errors = writer.close()                      # waits for every file
+
+save() renders the figure to a raw RGBA buffer in the calling
+thread, since matplotlib is not thread-safe, and queues it. The
+encoder threads write the buffer with matplotlib's own PNG writer,
+so the files are byte-identical to savefig's whatever the number of
+workers; workers=0 encodes in the calling thread. Any other
+compression level than the default is encoded by encode_png(), which
+filters and deflates the buffer with NumPy and zlib. The queue holds
+at most `depth` buffers, so memory stays bounded: save() blocks
+while it is full.
+
+Each run may also collect every figure into one bundle: a multi-page
+PDF, or a zip of SVG files. Bundles are written in the calling thread
+and replace an earlier bundle only if they hold at least one figure.
+
+When tracing, every file written adds a 'png.write' record, attributed
+to the spec that saved it; records of the encoder threads are added
+to the trace by flush() and close().
+"""
+import io
+import os
+import struct
+import threading
+import time
+import traceback
+import zipfile
+import zlib
+from Queue import Queue
+
+import numpy as np
+
+from hfa import trace
+from hfa.store import replace_file
+
+BUNDLES = ('pdf', 'svg')
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+DEFAULT_COMPRESSION = 6  # the level matplotlib writes PNG files with
+INCH = 0.0254
+
+
+def _chunk(kind, data):
+    return (struct.pack('>I', len(data)) + kind + data
+            + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+
+def encode_png(rgba, width, height, dpi=None, compression=DEFAULT_COMPRESSION):
+    '''
+    Encode an 8-bit RGBA buffer as PNG bytes, every scanline with the
+    Up filter.
+
+    Parameters
+    ----------
+    rgba: string or buffer
+       width x height x 4 bytes, rows from the top.
+    dpi: float (optional)
+       Stored as the physical pixel size.
+    compression: int (optional)
+       zlib level, 0 (none) to 9 (smallest).
+    '''
+    rows = np.frombuffer(rgba, dtype=np.uint8).reshape(height, width * 4)
+    filtered = np.empty((height, width * 4 + 1), dtype=np.uint8)
+    filtered[:, 0] = 2  # Up: each byte minus the one above, mod 256
+    filtered[0, 1:] = rows[0]
+    np.subtract(rows[1:], rows[:-1], out=filtered[1:, 1:])
+    header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+    png = [PNG_SIGNATURE, _chunk(b'IHDR', header)]
+    if dpi:
+        ppm = int(round(dpi / INCH))
+        png.append(_chunk(b'pHYs', struct.pack('>IIB', ppm, ppm, 1)))
+    png.append(_chunk(b'IDAT', zlib.compress(filtered.tostring(), compression)))
+    png.append(_chunk(b'IEND', b''))
+    return b''.join(png)
+
+
+def rasterize(figure):
+    '''
+    Render a figure as savefig would, with Agg whatever the current
+    backend; return (rgba, width, height, dpi).
+    '''
+    import matplotlib
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    buf = io.BytesIO()
+    original = figure.canvas
+    canvas = FigureCanvasAgg(figure)
+    try:
+        figure.savefig(buf, format='raw')
+    finally:
+        figure.set_canvas(original)
+    dpi = matplotlib.rcParams['savefig.dpi']
+    if dpi == 'figure':
+        dpi = figure.dpi
+    renderer = canvas.renderer  # the one savefig drew with
+    width, height = int(renderer.width), int(renderer.height)
+    return buf.getvalue(), width, height, dpi
+
+
+class FigureWriter(object):
+    '''
+    Write figures as PNG files through a bounded queue of encoder threads.
+
+    Parameters
+    ----------
+    workers: int (optional)
+       Encoder threads; 0 encodes in the calling thread.
+    depth: int (optional)
+       Rasterized figures that may wait for an encoder before save()
+       blocks; bounds the memory held by the queue.
+    compression: int (optional)
+       zlib level of the PNG files, 0 to 9. Only the default writes
+       the same bytes as savefig.
+    bundle: string (optional)
+       'pdf' or 'svg' also collects every figure into `bundle_path`
+       as a multi-page PDF or a zip of SVG files.
+    bundle_path: string (optional)
+       Path of the bundle without extension.
+    '''
+
+    def __init__(self, workers=0, depth=4, compression=DEFAULT_COMPRESSION,
+                 bundle=None, bundle_path=os.path.join('img', 'charts')):
+        if bundle not in (None,) + BUNDLES:
+            raise ValueError('Unknown bundle {!r}, use one of {}'.format(
+                bundle, ', '.join(BUNDLES)))
+        if not 0 <= compression <= 9:
+            raise ValueError('compression must be between 0 and 9')
+        self.compression = compression
+        self.errors = []
+        self.written = 0
+        self._spans = []
+        self._lock = threading.Lock()
+        self._queue = Queue(max(1, depth))
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name='png-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        self.bundle = bundle
+        self.bundle_path = None
+        self.bundled = 0
+        self._bundle = None
+        if bundle:
+            self.bundle_path = '{}.{}'.format(bundle_path, 'pdf' if bundle == 'pdf'
+                                              else 'svg.zip')
+            # written aside, so a run without figures keeps the last bundle
+            tmp = self.bundle_path + '.tmp'
+            if bundle == 'pdf':
+                from matplotlib.backends.backend_pdf import PdfPages
+                self._bundle = PdfPages(tmp)
+            else:
+                self._bundle = zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED)
+
+    def save(self, figure, path):
+        '''
+        Rasterize `figure` and queue it to be written to `path`; blocks
+        while the queue is full. With workers=0 the file is written
+        before returning.
+        '''
+        if self._bundle is not None:
+            self._add_to_bundle(figure, path)
+        task = (path,) + rasterize(figure) + (trace.current('spec'),)
+        if self._threads:
+            self._queue.put(task)
+        else:
+            self._write(task)
+            self._add_spans()
+
+    def _add_to_bundle(self, figure, path):
+        if self.bundle == 'pdf':
+            self._bundle.savefig(figure)
+        else:
+            svg = io.BytesIO()
+            figure.savefig(svg, format='svg')
+            name = os.path.splitext(os.path.basename(path))[0] + '.svg'
+            self._bundle.writestr(name, svg.getvalue())
+        self.bundled += 1
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                self._write(task)
+            except Exception:
+                with self._lock:
+                    self.errors.append((task[0], traceback.format_exc()))
+            finally:
+                self._queue.task_done()
+
+    def _write(self, task):
+        path, rgba, width, height, dpi, spec = task
+        start = time.time()
+        tmp = '{}.{}.tmp'.format(path, threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            if self.compression == DEFAULT_COMPRESSION:
+                from matplotlib import _png
+                pixels = np.frombuffer(rgba, np.uint8).reshape(height, width, 4)
+                _png.write_png(pixels, f, dpi)
+            else:
+                f.write(encode_png(rgba, width, height, dpi, self.compression))
+        replace_file(tmp, path)
+        with self._lock:
+            self.written += 1
+            if trace.enabled():
+                self._spans.append(trace.record(
+                    'png.write', start, time.time() - start, spec=spec,
+                    path=path, thread=threading.current_thread().name))
+
+    def _add_spans(self):
+        with self._lock:
+            spans, self._spans = self._spans, []
+        trace.extend(spans)
+
+    def flush(self):
+        '''Wait until every queued figure is written.'''
+        self._queue.join()
+        self._add_spans()
+
+    def close(self):
+        '''
+        Write every queued figure, stop the threads and close the bundle.
+
+        Returns
+        ----------
+        The list of (path, traceback) of the files that failed.
+        '''
+        self.flush()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self._bundle is not None:
+            self._bundle.close()
+            self._bundle = None
+            tmp = self.bundle_path + '.tmp'
+            if self.bundled:
+                replace_file(tmp, self.bundle_path)
+            else:
+                os.remove(tmp)
+                self.bundle_path = None
+        return self.errors
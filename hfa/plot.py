@@ -1,4 +1,5 @@
 from __future__ import division
+import copy
 import os
 from pprint import pformat
 
@@ -7,15 +8,32 @@ from prettyplotlib import plt
 import numpy as np
 import pandas as pd
 
+from hfa import derived, trace
+from hfa.output import FigureWriter
+from hfa.render_cache import IMG_DIR, fingerprint
+
 
 class SmallMultipleChart(object):
-    def __init__(self, plot, langs=['en', 'ru']):
+    def __init__(self, plot, langs=['en', 'ru'], relabel=True, writer=None):
+        '''
+        With `relabel` (the default) one grid is drawn for the first
+        language and only its text artists -- titles, facet labels,
+        caption and data source -- are swapped before saving each
+        further language. Otherwise every language gets its own grid.
+
+        Figures are saved through `writer`, a hfa.output.FigureWriter,
+        or written in this thread if it is None.
+        '''
         self.plot = plot
         self.langs = langs
+        self.relabel = relabel
+        self.writer = writer or FigureWriter()
         self._set_defaults()
 
+        self.labels = {}
+        self.facet_labels = []
         self.figures = {}
-        for lang in self.langs:
+        for lang in (self.langs[:1] if relabel else self.langs):
             self.plot.specs['facets'] = len(self.plot.specs['countries'])
             rows, cols = self._get_grid(self.plot.specs['facets'])
             self.plot.specs['cols'] = cols
@@ -28,37 +46,68 @@ class SmallMultipleChart(object):
         # Set global font to ensure ability to display Cyrillic
         plt.rc('font', **{'sans-serif': ['Helvetica', 'Arial'],
                           'family': 'sans-serif'})
+        if self.relabel:
+            figure, ax_array = self.figures[self.langs[0]]
+            for lang in self.langs:
+                if lang == self.langs[0]:
+                    with trace.span('chart.draw', lang=lang):
+                        figure, title = self._set_up_figure(figure, lang)
+                        self._get_axis_limits()
+                        self._render_axes(ax_array, lang)
+                else:
+                    with trace.span('chart.relabel', lang=lang):
+                        title = self._relabel(lang)
+                self._save_fig(figure, title, lang)
+            plt.close(figure)
+            return
+
         for lang in self.langs:
             figure, ax_array = self.figures[lang]
-            figure, title = self._set_up_figure(figure, lang)
-            self._get_axis_limits()
-            self._render_axes(ax_array, lang)
+            with trace.span('chart.draw', lang=lang):
+                figure, title = self._set_up_figure(figure, lang)
+                self._get_axis_limits()
+                self._render_axes(ax_array, lang)
             self._save_fig(figure, title, lang)
+            plt.close(figure)
+
+    def _relabel(self, lang):
+        '''Swap the text of every language-dependent artist to `lang`.'''
+        title = self._get_title(lang)
+        self.labels['title'].set_text(title)
+        self.labels['data_source'].set_text(self._get_data_source(lang))
+        if 'caption' in self.labels:
+            self.labels['caption'].set_text(self.plot.specs['caption'][lang])
+        for text, names in self.facet_labels:
+            text.set_text(names[lang])
+        return title
 
     def _get_axis_limits(self):
+        extents = self.plot.axis_extents()
         xmin = self.plot.specs.get('xmin', '')
         if xmin != '':
-            xmin = self.plot.data.year.min()
+            xmin = extents['xmin']
 
         xmax = self.plot.specs.get('xmax', '')
         if xmax != '':
-            xmax = self.plot.data.year.max()
+            xmax = extents['xmax']
         self.plot.specs['xlim'] = (xmin, xmax)
 
         ymin = self.plot.specs.get('ymin', '')
         if ymin == '':
-            ymin = 100 * int((self.plot.data.value.min() - 95) / 100)
+            ymin = 100 * int((extents['ymin'] - 95) / 100)
         ymax = self.plot.specs.get('ymax', '')
         if ymax == '':
-            ymax = 100 * int((self.plot.data.value.max() + 95) / 100)
+            ymax = 100 * int((extents['ymax'] + 95) / 100)
         self.plot.specs['ylim'] = (ymin, ymax)
 
     def _render_axes(self, ax_array, lang):
         comp_series = {}
         for comp in self.plot.specs['comparators']:
-            y_comp = self.plot.data[self.plot.data.country == comp].value
-            x_comp = self.plot.data[self.plot.data.country == comp].year
-            comp_series[comp] = (x_comp, y_comp)
+            comp_series[comp] = self.plot.country_series(comp)
+
+        # Facet names come straight from the index hash maps
+        country_ids = self.plot.index.ids['countries']
+        records = self.plot.index.records['countries']
 
         for facet in range(self.plot.specs['facets']):
             cols = self.plot.specs['cols']
@@ -67,15 +116,16 @@ class SmallMultipleChart(object):
             ax = ax_array[r][c]
 
             country = self.plot.specs['countries'][facet]
-            country = self.plot.index.get_countries(names=[country])
-            y = self.plot.data[self.plot.data.country == country['en'][0]].value
-            x = self.plot.data[self.plot.data.country == country['en'][0]].year
+            en, ru = records[country_ids[country]]
+            country = {'en': en, 'ru': ru}
+            x, y = self.plot.country_series(country['en'])
 
-            ax_title = country[lang][0]
-            ax.text(0.5, 0.95, ax_title,
-                    verticalalignment='bottom', horizontalalignment='center',
-                    transform=ax.transAxes, color=self.plot.specs.get('color', None),
-                    fontsize=10, fontweight='bold')
+            ax_title = country[lang]
+            text = ax.text(0.5, 0.95, ax_title,
+                           verticalalignment='bottom', horizontalalignment='center',
+                           transform=ax.transAxes, color=self.plot.specs.get('color', None),
+                           fontsize=10, fontweight='bold')
+            self.facet_labels.append((text, country))
 
             ax.set_ylim(self.plot.specs['ylim'])
             if self.plot.specs.get('ystep', None):
@@ -112,14 +162,15 @@ class SmallMultipleChart(object):
         figure.set_size_inches(width, height)
 
         # Add a main title
-        figure.suptitle(title, fontweight='heavy', fontsize=18)
+        self.labels['title'] = figure.suptitle(title, fontweight='heavy', fontsize=18)
         # Add annotation crediting the source of data at bottom of slide
-        figure.text(0.5, 0.02, data_source, fontsize=14, horizontalalignment='center')
+        self.labels['data_source'] = figure.text(0.5, 0.02, data_source, fontsize=14,
+                                                 horizontalalignment='center')
 
         caption = self.plot.specs.get('caption', None)
         if caption:
-            figure.text(caption['x'], caption['y'], 
-                        caption[lang], fontsize=caption['size'])
+            self.labels['caption'] = figure.text(caption['x'], caption['y'], 
+                                                 caption[lang], fontsize=caption['size'])
 
         return figure, title
 
@@ -163,7 +214,7 @@ class SmallMultipleChart(object):
         title = self.plot.specs.get('title', {}).get(lang, '')
         if not title:
             key = self.plot.specs.get('indicator', '')
-            title = self.plot.index[key][lang][0]
+            title = indicator_title(self.plot.index, key, lang)
         return title
 
     def _get_data_source(self, lang):
@@ -173,62 +224,201 @@ class SmallMultipleChart(object):
         return data_source
 
     def _save_fig(self, figure, title, lang):
-        # Show and save the whole thing
-        stub = self.plot.specs.get('filename', '')
-        stub = stub if stub else self.plot.specs['indicator']
-        fn = '{}_{}.png'.format(stub, lang)
-        fn = os.path.join('img', fn)
-        figure.savefig(fn)
+        # Rasterized here; encoded and written by the writer
+        with trace.span('chart.savefig', lang=lang):
+            self.writer.save(figure, self.plot.output_path(lang))
 
     def _set_defaults(self):
         self.plot.specs['color'] = self.plot.specs.get('color', 'red')
 
 
 class Plot(object):
-    def __init__(self, specs, index, hfa_db):
-        self.specs = specs
+    LANGS = ['en', 'ru']
+
+    def __init__(self, specs, index, hfa_db, coverage=None):
+        # SmallMultipleChart writes its layout into the specs; keep the
+        # caller's dict, and so the fingerprint, unchanged
+        self.specs = copy.deepcopy(specs)
         self.specs['countries'] = sorted(self.specs['countries'])
         self.index = index
+        self.coverage = coverage
         self.data = self.get_plot_dataset(hfa_db)
-
-    def render(self):
+        self.by_country, self.extents = self.split_by_country(self.data)
+
+    def render(self, cache=None, writer=None):
+        '''
+        Render the chart in every language.
+
+        Parameters
+        ----------
+        cache: hfa.render_cache.RenderCache (optional)
+           If given, skip rendering when all outputs exist with a
+           matching fingerprint.
+        writer: hfa.output.FigureWriter (optional)
+           Writes the files, possibly after this returns; by default
+           they are written before it returns.
+
+        Returns
+        ----------
+        A dict of output path -> fingerprint of the files written,
+        empty if nothing was rendered or no cache was given.
+        '''
         if self.specs['type'] == 'Small multiples':
-            chart = SmallMultipleChart(self)
+            outputs = [self.output_path(lang) for lang in self.LANGS]
+            key = None
+            if cache is not None:
+                with trace.span('plot.fingerprint'):
+                    key = self.fingerprint()
+                if cache.is_fresh(outputs, key):
+                    return {}
+            with trace.span('chart.grid'):
+                chart = SmallMultipleChart(self, self.LANGS, writer=writer)
             chart.render()
+            if key:
+                return dict.fromkeys(outputs, key)
+        return {}
+
+    def output_path(self, lang):
+        stub = self.specs.get('filename', '')
+        stub = stub if stub else self.specs['indicator']
+        fn = '{}_{}.png'.format(stub, lang)
+        return os.path.join(IMG_DIR, fn)
+
+    def fingerprint(self):
+        '''Hash of the spec, data slice and index labels of this plot.'''
+        key = self.specs.get('indicator', '')
+        countries = self.index.records['countries']
+        labels = {'title': [indicator_title(self.index, key, lang)
+                            for lang in self.LANGS],
+                  'countries': [countries.get(self.index.get_id(c, 'countries'))
+                                for c in self.specs['countries']]}
+        return fingerprint(self.specs, self.data, labels)
 
     def get_plot_dataset(self, hfa_db):
+        return get_plot_dataset(self.specs, self.index, hfa_db)
+
+    @staticmethod
+    def split_by_country(data):
+        '''
+        Split the plot dataset once into contiguous per-country arrays.
+
+        Returns
+        ----------
+        by_country: dict
+           English country name -> (years, values) numpy arrays,
+           in the year order of `data`.
+        extents: dict
+           xmin, xmax, ymin, ymax of the whole dataset (None if empty).
+        '''
+        years = np.asarray(data['year'])
+        values = np.asarray(data['value'], dtype=np.float64)
+        codes, countries = pd.factorize(np.asarray(data['country']))
+        order = np.argsort(codes, kind='mergesort')
+        bounds = np.searchsorted(codes[order], np.arange(len(countries) + 1))
+        by_country = {}
+        for i, country in enumerate(countries):
+            rows = order[bounds[i]:bounds[i + 1]]
+            by_country[country] = (years[rows], values[rows])
+
+        extents = dict.fromkeys(['xmin', 'xmax', 'ymin', 'ymax'])
+        if len(years):
+            extents.update(xmin=years.min(), xmax=years.max(),
+                           ymin=values.min(), ymax=values.max())
+        return by_country, extents
+
+    def axis_extents(self):
+        '''
+        Return the xmin, xmax, ymin and ymax the default axis limits are
+        taken from, read from the store coverage where it is exact.
+
+        The coverage describes stored country series only. Comparators,
+        group means among them, and derived expressions fall back to the
+        one-pass extents of the plot's own data, as do the values when
+        xmin or xmax cut a series (see hfa.coverage.Coverage.extents).
+        '''
         key = self.specs.get('indicator', '')
-        indicator = self.index[key]
-        countries = self.specs.get('countries', [])
-        comparators = self.specs.get('comparators', [])
-        all_countries = countries + comparators
-        end = self.specs.get('xmax', None)
-        start = self.specs.get('xmin', None)
-        dataset = self._get_plot_data(all_countries,
-                                      indicator,
-                                      start,
-                                      end,
-                                      hfa_db)
-        return dataset
-
-    def _get_plot_data(self, all_countries, indicator, start, end, hfa_db):
-        assert isinstance(all_countries, list)
-        assert isinstance(indicator, pd.DataFrame)
-        assert isinstance(hfa_db, pd.DataFrame)
-
-        if not start or not isinstance(start, int):
-            start = hfa_db.year.min()
-        if not end or not isinstance(end, int):
-            end = hfa_db.year.max()
-
-        data = hfa_db[hfa_db.country.isin(all_countries)]
-        data = data[data.indicator == indicator.en[0]]
-        data = data[data.year >= start]
-        data = data[data.year <= end]
-        data.sort('year', inplace=True)
-        return data
+        countries = self.specs['countries']
+        if (self.coverage is None or self.specs.get('comparators')
+                or derived.is_expression(key)
+                or any(c not in self.coverage.country_ids for c in countries)):
+            return self.extents
+        start, end = self.specs.get('xmin'), self.specs.get('xmax')
+        extents = self.coverage.extents(
+            self.index[key].en[0], countries,
+            start if isinstance(start, int) else None,
+            end if isinstance(end, int) else None)
+        for limit in ('ymin', 'ymax'):
+            if extents[limit] is None:
+                extents[limit] = self.extents[limit]
+        return extents
+
+    def country_series(self, country):
+        '''Return the (years, values) arrays of one country, empty if absent.'''
+        empty = (np.array([], dtype=np.int64), np.array([], dtype=np.float64))
+        return self.by_country.get(country, empty)
 
     def __repr__(self):
         return pformat(dict(specs=self.specs,
                             index=self.index,
                             data=self.data))
+
+
+def indicator_title(index, key, lang):
+    '''Name of a spec's indicator id, or title of a derived expression.'''
+    if derived.is_expression(key):
+        return derived.describe(key, index, lang)
+    return index.get_name(key, lang)
+
+
+def get_plot_dataset(specs, index, hfa_db):
+    '''
+    Return the long-format rows a plot spec asks for: its indicator,
+    countries and comparators between xmin and xmax, sorted by year.
+
+    Parameters
+    ----------
+    specs: dict
+       A plot spec with 'indicator', 'countries' and optionally
+       'comparators', 'xmin' and 'xmax'.
+    index: hfa.indices.HFAIndex
+    hfa_db: Pandas DataFrame or an object with a query() method
+       such as hfa.series.SeriesIndex. Derived-indicator expressions
+       need hfa.derived.DerivedIndicators.
+    '''
+    key = specs.get('indicator', '')
+    if derived.is_expression(key):
+        if not hasattr(hfa_db, 'evaluate'):
+            raise ValueError('Derived indicator {!r} needs '
+                             'hfa.derived.DerivedIndicators data'.format(key))
+        indicator = key
+    else:
+        indicator = index[key].en[0]
+    countries = list(specs.get('countries', []))
+    comparators = specs.get('comparators', [])
+    all_countries = countries + comparators
+    end = specs.get('xmax', None)
+    start = specs.get('xmin', None)
+    return _get_plot_data(all_countries, indicator, start, end, hfa_db)
+
+
+def _get_plot_data(all_countries, indicator, start, end, hfa_db):
+    assert isinstance(all_countries, list)
+
+    # Indexed data (e.g. hfa.series.SeriesIndex) answers by binary search
+    if hasattr(hfa_db, 'query') and not isinstance(hfa_db, pd.DataFrame):
+        start = start if isinstance(start, int) else None
+        end = end if isinstance(end, int) else None
+        return hfa_db.query(indicator, all_countries, start, end)
+
+    assert isinstance(hfa_db, pd.DataFrame)
+    if not start or not isinstance(start, int):
+        start = hfa_db.year.min()
+    if not end or not isinstance(end, int):
+        end = hfa_db.year.max()
+
+    data = hfa_db[hfa_db.country.isin(all_countries)]
+    data = data[data.indicator == indicator]
+    data = data[data.year >= start]
+    data = data[data.year <= end]
+    data.sort('year', inplace=True)
+    return data
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache of rendered charts.
+
+Every output image is recorded in a manifest next to img/ together
+with a fingerprint of everything that went into drawing it: the merged
+plot spec, the exact data slice, the index labels and RENDERER_VERSION.
+A chart whose outputs all exist with a matching fingerprint is skipped.
+"""
+import hashlib
+import json
+import os
+
+from hfa.store import replace_file
+
+IMG_DIR = 'img'
+MANIFEST = 'render_manifest.json'
+
+# Bump whenever a change to hfa.plot alters the pixels it produces
+RENDERER_VERSION = '2'
+
+
+class RenderCache(object):
+    '''
+    Manifest of output path -> fingerprint for rendered charts.
+
+    Parameters
+    ----------
+    path: string (optional)
+       Path of the manifest, defaults to ./render_manifest.json,
+       next to the img directory.
+    '''
+
+    def __init__(self, path=MANIFEST):
+        self.path = path
+        try:
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def is_fresh(self, outputs, fingerprint):
+        '''True if every output exists and was rendered from `fingerprint`.'''
+        return all(self.entries.get(path) == fingerprint and os.path.exists(path)
+                   for path in outputs)
+
+    def update(self, rendered):
+        '''Record a dict of output path -> fingerprint.'''
+        self.entries.update(rendered)
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        replace_file(tmp, self.path)
+
+
+def fingerprint(specs, data, labels):
+    '''
+    Return a hex digest of a plot spec, its data slice and labels.
+
+    Parameters
+    ----------
+    specs: dict
+       The merged plot spec.
+    data: Pandas DataFrame
+       The long-format slice returned by Plot.get_plot_dataset.
+    labels: object
+       Any JSON-serialisable structure of the index labels used.
+    '''
+    digest = hashlib.sha1(RENDERER_VERSION)
+    digest.update(json.dumps(specs, sort_keys=True, default=repr))
+    digest.update(json.dumps(labels, sort_keys=True, default=repr))
+    for col in ['country', 'indicator']:
+        digest.update(json.dumps(list(data[col]), default=repr))
+    for col in ['country_id', 'year', 'value']:
+        digest.update(data[col].values.tostring())
+    return digest.hexdigest()
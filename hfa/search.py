@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Ranked text search over indicator names in English and Russian.
+
+IndicatorSearch builds an inverted index of case-folded word tokens
+(with ё folded to е) once, so each query costs a few dictionary
+lookups rather than a scan of every name. A query token matches
+index tokens exactly, as a prefix (found by bisection of the sorted
+vocabulary) or, failing both, fuzzily by shared character trigrams.
+Matches are weighted by inverse document frequency and the best
+indicator ids are returned first.
+
+The module depends on the standard library only, so that lookup
+tools can import it quickly.
+"""
+import bisect
+import math
+import re
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+
+# Relative weight of the three kinds of token match
+EXACT = 1.0
+PREFIX = 0.8
+FUZZY = 0.5
+
+# Minimum trigram similarity (Jaccard) of a fuzzy match
+MIN_SIMILARITY = 0.4
+
+
+def fold(text):
+    '''Lower-case `text` (bytes are read as UTF-8) and fold ё to е.'''
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    return text.lower().replace(u'ё', u'е')
+
+
+def tokenize(text):
+    return TOKEN.findall(fold(text))
+
+
+def trigrams(token):
+    padded = u'^{}$'.format(token)
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class IndicatorSearch(object):
+    '''
+    Inverted index of indicator names.
+
+    Parameters
+    ----------
+    records: iterable of (idx, en, ru) tuples
+       As held by Extractor.records['indicators'].
+    '''
+
+    def __init__(self, records):
+        self.names = {}
+        self.postings = {}
+        for idx, en, ru in records:
+            en, ru = tokenize(en), tokenize(ru)
+            self.names[idx] = (u' '.join(en), u' '.join(ru))
+            for token in en + ru:
+                self.postings.setdefault(token, set()).add(idx)
+        self.vocabulary = sorted(self.postings)
+        self.idf = dict((token, math.log(1.0 + len(self.names) / float(len(ids))))
+                        for token, ids in self.postings.items())
+        self.grams = {}
+        for token in self.vocabulary:
+            for gram in trigrams(token):
+                self.grams.setdefault(gram, set()).add(token)
+
+    def expand(self, token):
+        '''
+        Return a dict of index token -> match weight for one query token:
+        the exact token and tokens it prefixes, or else the tokens that
+        share enough trigrams with it.
+        '''
+        matches = {}
+        vocabulary = self.vocabulary
+        i = bisect.bisect_left(vocabulary, token)
+        while i < len(vocabulary) and vocabulary[i].startswith(token):
+            matches[vocabulary[i]] = EXACT if vocabulary[i] == token else PREFIX
+            i += 1
+        if matches:
+            return matches
+
+        grams = trigrams(token)
+        counts = {}
+        for gram in grams:
+            for candidate in self.grams.get(gram, ()):
+                counts[candidate] = counts.get(candidate, 0) + 1
+        for candidate, shared in counts.items():
+            similarity = shared / float(len(grams | trigrams(candidate)))
+            if similarity >= MIN_SIMILARITY:
+                matches[candidate] = FUZZY * similarity
+        return matches
+
+    def search(self, query, limit=10):
+        '''
+        Return up to `limit` (idx, score) pairs for `query`, best first.
+        Every query token contributes its best match per indicator;
+        a match of the whole query as a phrase scores a bonus. Ties
+        go to the shorter name, then to the lower id.
+        '''
+        tokens = tokenize(query)
+        scores = {}
+        for token in tokens:
+            best = {}
+            for candidate, weight in self.expand(token).items():
+                score = weight * self.idf[candidate]
+                for idx in self.postings[candidate]:
+                    if score > best.get(idx, 0):
+                        best[idx] = score
+            for idx, score in best.items():
+                scores[idx] = scores.get(idx, 0) + score
+
+        phrase = u' '.join(tokens)
+        if len(tokens) > 1:
+            for idx in scores:
+                if any(phrase in name for name in self.names[idx]):
+                    scores[idx] *= 1.5
+
+        ranked = sorted(scores.items(),
+                        key=lambda item: (-item[1],
+                                          len(self.names[item[0]][0]),
+                                          item[0]))
+        return ranked[:limit] if limit else ranked
+
+    def ids(self, query, limit=10):
+        '''Return the ids of the best `limit` indicators for `query`.'''
+        return [idx for idx, _ in self.search(query, limit)]
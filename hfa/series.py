@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Indexed access to HFA time series.
+
+A SeriesIndex keeps every indicator as columns sorted by
+(country_id, year), so that an (indicator, countries, year range)
+query is answered by binary search and slicing rather than by
+boolean scans over the whole master frame.
+"""
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from hfa.store import COLUMNS, DTYPES, dedupe_last, empty_frame
+
+
+class SeriesIndex(object):
+    '''
+    Sorted-offset table over long-format HFA data.
+
+    Use SeriesIndex.from_store() to index a memory-mapped
+    hfa.store.ColumnarStore without copying it, or
+    SeriesIndex.from_frame() to index a DataFrame in the format of
+    DataImporter.DF.
+
+    Parameters
+    ----------
+    columns: callable or dict
+       Maps an English indicator name to a dict of country_id, year
+       and value arrays sorted by (country_id, year).
+    indicators: list of strings
+       The indicator names available.
+    countries: dict
+       country_id -> country name.
+    version: string (optional)
+       Identifies the state of the data, e.g. ColumnarStore.version.
+    '''
+
+    def __init__(self, columns, indicators, countries, version=None):
+        self._columns = columns
+        self.version = version
+        self.indicators = sorted(indicators)
+        self.countries = dict(countries)
+        self.country_ids = dict((name, cid) for cid, name in self.countries.items())
+        self._names = np.empty(max(self.countries) + 1 if self.countries else 0,
+                               dtype=object)
+        for cid, name in self.countries.items():
+            self._names[cid] = name
+
+    @classmethod
+    def from_store(cls, store, indicators=None, countries=None):
+        '''
+        Index a ColumnarStore, optionally restricted to the English
+        names of some `indicators` and `countries`. Partitions are
+        still read on first use only; with `countries`, just their
+        rows are kept.
+        '''
+        available = store.indicators
+        if indicators is not None:
+            wanted = set(indicators)
+            available = [i for i in available if i in wanted]
+        names = store.countries
+        columns = store.partition
+        if countries is not None:
+            wanted = set(countries)
+            names = dict((cid, name) for cid, name in names.items()
+                         if name in wanted)
+            columns = _select_rows(store, np.array(sorted(names), dtype=np.int64))
+        return cls(columns, available, names, store.version)
+
+    @classmethod
+    def from_frame(cls, df):
+        parts = {}
+        for indicator, rows in df.groupby('indicator'):
+            parts[indicator] = dedupe_last(
+                dict((col, np.asarray(rows[col], dtype=dtype))
+                     for col, dtype in DTYPES.items()))
+        countries = dict(zip(df['country_id'].astype(int), df['country']))
+        return cls(parts.__getitem__, parts.keys(), countries)
+
+    def __contains__(self, indicator):
+        return indicator in self.indicators
+
+    def columns(self, indicator):
+        '''Return the sorted country_id, year and value arrays of an indicator.'''
+        return self._columns(indicator)
+
+    def offsets(self, indicator, countries, start=None, end=None):
+        '''
+        Return the row positions of `countries` (names) with
+        start <= year <= end within the indicator's columns, in the
+        order of `countries` and then of year. A name given twice is
+        selected once.
+        '''
+        if indicator not in self:
+            return np.array([], dtype=np.intp)
+        part = self.columns(indicator)
+        cid, year = part['country_id'], part['year']
+        ranges = []
+        for country in OrderedDict.fromkeys(countries):
+            c = self.country_ids.get(country)
+            if c is None:
+                continue
+            lo = np.searchsorted(cid, c, 'left')
+            hi = np.searchsorted(cid, c, 'right')
+            if start is not None:
+                lo += np.searchsorted(year[lo:hi], start, 'left')
+            if end is not None:
+                hi = lo + np.searchsorted(year[lo:hi], end, 'right')
+            if hi > lo:
+                ranges.append(np.arange(lo, hi))
+        if not ranges:
+            return np.array([], dtype=np.intp)
+        return np.concatenate(ranges)
+
+    def query(self, indicator, countries, start=None, end=None):
+        '''
+        Return the long-format rows of one indicator for the given
+        countries and inclusive year range, sorted by year.
+
+        Parameters
+        ----------
+        indicator: string
+           English indicator name.
+        countries: list of strings
+           English country names.
+        start, end: int (optional)
+           Inclusive year bounds. If None, unbounded.
+        '''
+        rows = self.offsets(indicator, countries, start, end)
+        if not len(rows):
+            return empty_frame()
+        part = self.columns(indicator)
+        cid = part['country_id'][rows]
+        year = part['year'][rows]
+        order = np.argsort(year, kind='mergesort')
+        indicators = np.empty(len(rows), dtype=object)
+        indicators.fill(indicator)
+        return pd.DataFrame({'country_id': cid[order].astype(np.int64),
+                             'country': self._names.take(cid[order].astype(np.intp)),
+                             'indicator': indicators,
+                             'year': year[order].astype(np.int64),
+                             'value': part['value'][rows][order]},
+                            columns=COLUMNS)
+
+
+def _select_rows(store, country_ids):
+    '''Wrap store.partition to keep only the rows of `country_ids`.'''
+    selected = {}
+
+    def columns(indicator):
+        if indicator not in selected:
+            part = store.partition(indicator)
+            keep = np.in1d(part['country_id'], country_ids)
+            selected[indicator] = dict((col, np.asarray(values)[keep])
+                                       for col, values in part.items())
+            store.release(indicator)
+        return selected[indicator]
+    return columns
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Local JSON query server over the HFA store.
+
+The data, index and country sets are loaded once; each request is
+answered from memory with the same selection rules as plot specs
+(hfa.plot.get_plot_dataset) and country set expansion
+(hfa.specs.expand_country_sets). Recent responses are kept in an
+LRU cache. Requests are served concurrently, one thread each.
+
+    python -m hfa.server --port 8765
+
+    GET /series?indicator=0260&countries=cis,Malta&start=1998&end=2012&lang=ru
+
+returns
+
+    {"indicator": "0260", "name": "...", "lang": "ru",
+     "start": 1998, "end": 2012,
+     "series": [{"country": "Malta", "id": "0030", "name": "...",
+                 "years": [...], "values": [...]}, ...]}
+
+where missing values are null. Countries may be country names, keys
+of country_sets.yaml or group means such as mean(eu); the indicator
+may be a derived expression such as rolling(1320, 3).
+"""
+from __future__ import print_function
+import argparse
+import json
+import threading
+import time
+import traceback
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import OrderedDict
+from SocketServer import ThreadingMixIn
+
+import numpy as np
+
+from hfa.aggregate import Aggregator
+from hfa.derived import DerivedIndicators
+from hfa.importer import DataImporter
+from hfa.indices import HFAIndex
+from hfa.plot import Plot, get_plot_dataset, indicator_title
+from hfa.specs import expand_country_sets, load_country_sets
+
+
+class QueryError(ValueError):
+    '''A request that cannot be answered; carries the HTTP status.'''
+
+    def __init__(self, message, status=400):
+        super(QueryError, self).__init__(message)
+        self.status = status
+
+
+class LRUCache(object):
+    '''A thread-safe mapping that keeps the `size` most recently used keys.'''
+
+    def __init__(self, size=256):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class QueryService(object):
+    '''
+    Answer time-series queries from data loaded once.
+
+    Parameters
+    ----------
+    hfa_db: object with a query() method
+       Usually hfa.derived.DerivedIndicators over an
+       hfa.aggregate.Aggregator over DataImporter().series.
+    index: hfa.indices.HFAIndex
+    country_sets: dict
+       The parsed country_sets.yaml.
+    cache_size: int (optional)
+       Number of responses kept in the LRU cache.
+    '''
+
+    def __init__(self, hfa_db, index, country_sets, cache_size=256):
+        self.hfa_db = hfa_db
+        self.index = index
+        self.country_sets = country_sets
+        self.cache = LRUCache(cache_size)
+
+    @classmethod
+    def load(cls, cache_size=256):
+        index = HFAIndex()
+        country_sets = load_country_sets()
+        hfa_db = DerivedIndicators(
+            Aggregator(DataImporter().series, index, country_sets), index)
+        return cls(hfa_db, index, country_sets, cache_size)
+
+    def series(self, indicator, countries, start=None, end=None, lang='en'):
+        '''Return the JSON text of one query, from the cache if possible.'''
+        key = (indicator, tuple(sorted(countries)), start, end, lang)
+        body = self.cache.get(key)
+        if body is None:
+            body = json.dumps(self._series(indicator, countries, start, end, lang))
+            self.cache.put(key, body)
+        return body
+
+    def _series(self, indicator, countries, start, end, lang):
+        if lang not in Plot.LANGS:
+            raise QueryError('lang must be one of {}'.format(', '.join(Plot.LANGS)))
+        name = indicator_title(self.index, indicator, lang)
+        if name is None:
+            raise QueryError('Unknown indicator {!r}'.format(indicator), 404)
+        specs = {'indicator': indicator,
+                 'countries': sorted(expand_country_sets(countries,
+                                                         self.country_sets)),
+                 'xmin': start,
+                 'xmax': end}
+        data = get_plot_dataset(specs, self.index, self.hfa_db)
+        by_country, _ = Plot.split_by_country(data)
+        series = []
+        for country in specs['countries']:
+            if country not in by_country:
+                continue
+            years, values = by_country[country]
+            idx = self.index.get_id(country, 'countries')
+            label = self.index.get_name(idx, lang, 'countries') if idx else country
+            series.append({'country': country,
+                           'id': idx,
+                           'name': label,
+                           'years': years.tolist(),
+                           'values': [None if np.isnan(v) else v
+                                      for v in values.tolist()]})
+        return {'indicator': indicator, 'name': name, 'lang': lang,
+                'start': start, 'end': end, 'series': series}
+
+
+class Handler(BaseHTTPRequestHandler):
+    '''Route GET /series to the server's QueryService.'''
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != '/series':
+            return self._send(404, json.dumps({'error': 'Not found'}))
+        params = urlparse.parse_qs(url.query)
+        try:
+            indicator = params.get('indicator', [''])[0]
+            countries = [c.strip().decode('utf-8')
+                         for value in params.get('countries', [])
+                         for c in value.split(',') if c.strip()]
+            start = self._year(params, 'start')
+            end = self._year(params, 'end')
+            lang = params.get('lang', ['en'])[0]
+            body = self.server.service.series(indicator, countries,
+                                              start, end, lang)
+        except ValueError as e:  # QueryError, or e.g. an unknown country set
+            status = getattr(e, 'status', 400)
+            return self._send(status, json.dumps({'error': unicode(e)}))
+        except Exception:
+            # a bug, not a bad query: keep serving and say so
+            traceback.print_exc()
+            return self._send(500, json.dumps({'error': 'Internal server error'}))
+        self._send(200, body)
+
+    def _year(self, params, name):
+        if name not in params:
+            return None
+        try:
+            return int(params[name][0])
+        except ValueError:
+            raise QueryError('{} must be a year'.format(name))
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+
+class QueryServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service, verbose=False):
+        HTTPServer.__init__(self, address, Handler)
+        self.service = service
+        self.verbose = verbose
+
+
+def serve(host='127.0.0.1', port=8765, cache_size=256, verbose=False):
+    start = time.time()
+    service = QueryService.load(cache_size)
+    server = QueryServer((host, port), service, verbose)
+    print('Loaded in {:.1f}s, serving on http://{}:{}/series'.format(
+        time.time() - start, host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve HFA time series as JSON.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--cache', type=int, default=256,
+                        help='number of responses kept in the LRU cache')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log every request')
+    args = parser.parse_args()
+    serve(args.host, args.port, args.cache, args.verbose)
+
+
+if __name__ == '__main__':
+    main()
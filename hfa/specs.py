@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Reading plot specs and expanding the country sets they refer to.
+
+YAML is parsed with LibYAML's C loader when PyYAML was built with it.
+country_sets.yaml is parsed once per run and again only if it changes.
+"""
+from __future__ import print_function
+import glob
+import os
+
+import yaml
+
+YAML_DIR = os.path.join('yaml')
+CONFIG = os.path.join(YAML_DIR, 'config.yaml')
+IDX_DIR = os.path.join('hfa', 'index_data')
+COUNTRY_SETS = os.path.join(IDX_DIR, 'country_sets.yaml')
+
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# path -> (modification time, parsed country sets)
+_COUNTRY_SETS = {}
+
+
+def read_yaml_file(yaml_file):
+    with open(yaml_file, 'rb') as f:
+        specs = yaml.load(f, Loader=Loader)
+        print('Processed: {}'.format(yaml_file))
+    return specs
+
+
+def load_country_sets(path=COUNTRY_SETS):
+    '''Return the parsed country sets, re-read only when the file changes.'''
+    mtime = os.path.getmtime(path)
+    if path not in _COUNTRY_SETS or _COUNTRY_SETS[path][0] != mtime:
+        _COUNTRY_SETS[path] = (mtime, read_yaml_file(path))
+    return _COUNTRY_SETS[path][1]
+
+
+def spec_files(yaml_dir=YAML_DIR):
+    '''Paths of the plot specs, i.e. the YAML files other than config.'''
+    files = [f for f in glob.glob(os.path.join(yaml_dir, "*.yaml"))]
+    return [f for f in files if 'config' not in f]
+
+
+def load_spec(yaml_file, basic_config, country_sets):
+    '''Read one plot spec, merged over the general config, with its
+    country sets expanded.'''
+    specs = read_yaml_file(yaml_file)  # read specific config
+    final = basic_config.copy() if basic_config else dict() # merge it with general config
+    final.update(specs)
+    final['countries'] = expand_country_sets(final['countries'], country_sets)
+    # TODO generalise this
+    if final['indicator'] == 176:
+        final['indicator'] = '0260'
+    return final
+
+
+def spec_name(specs):
+    return specs.get('filename') or specs.get('indicator')
+
+
+def empty_facets(specs, index, coverage):
+    '''
+    Return the facet countries of a plot spec that have no data for
+    its indicator between xmin and xmax, from the coverage alone.
+
+    Derived indicators are checked against each indicator they read
+    over all years, since their transforms look outside the range.
+    Unknown indicators give an empty list; they fail when rendered.
+
+    Parameters
+    ----------
+    specs: dict
+       A plot spec, countries already expanded.
+    index: hfa.indices.HFAIndex
+    coverage: hfa.coverage.Coverage
+    '''
+    from hfa import derived
+
+    key = specs.get('indicator', '')
+    start, end = specs.get('xmin'), specs.get('xmax')
+    start = start if isinstance(start, int) else None
+    end = end if isinstance(end, int) else None
+    if derived.is_expression(key):
+        try:
+            needed, _ = derived.dependencies(derived.parse(key, index))
+        except ValueError:
+            return []
+        start = end = None
+    elif index.get_name(key) is not None:
+        needed = [index.get_name(key)]
+    else:
+        return []
+    countries = sorted(specs.get('countries', []))
+    empty = set()
+    for indicator in needed:
+        empty.update(coverage.empty_facets(indicator, countries, start, end))
+    return [c for c in countries if c in empty]
+
+
+def check_specs(plot_specs, index, coverage):
+    '''
+    Reject, before any rendering, the specs whose every facet would be
+    empty, and warn about single empty facets.
+
+    Returns
+    ----------
+    The list of specs to render and the list of (name, reason) of
+    the specs rejected.
+    '''
+    accepted, rejected = [], []
+    for specs in plot_specs:
+        name = spec_name(specs)
+        empty = empty_facets(specs, index, coverage)
+        if empty and len(empty) == len(specs.get('countries', [])):
+            reason = 'No data for {} in any of its {} countries'.format(
+                specs.get('indicator'), len(empty))
+            print('Rejected {}: {}'.format(name, reason))
+            rejected.append((name, reason))
+            continue
+        if empty:
+            print('{}: no data for {}'.format(
+                name, ', '.join(c.encode('utf-8') if isinstance(c, unicode) else c
+                                for c in empty)))
+        accepted.append(specs)
+    return accepted, rejected
+
+
+def expand_country_sets(countries, country_sets=None):
+    '''
+    Replace the names of country sets in `countries` by their members
+    and return the resulting set of names.
+
+    Parameters
+    ----------
+    countries: iterable of strings
+       Country names and/or keys of country_sets.yaml.
+    country_sets: dict (optional)
+       The parsed country_sets.yaml; load_country_sets() if not given.
+    '''
+    result = []
+    if country_sets is None:
+        country_sets = load_country_sets()
+    for idx in countries:
+        if idx in country_sets:
+            result.extend(country_sets[idx])
+        else:
+            result.append(idx)
+    return set(result)
+
+
+def spec_requirements(plot_specs, index, country_sets):
+    '''
+    Collect what a run over `plot_specs` reads from the data.
+
+    Parameters
+    ----------
+    plot_specs: list of dict
+       Specs as returned by main.get_yaml, countries already expanded.
+    index: hfa.indices.HFAIndex
+    country_sets: dict
+       The parsed country_sets.yaml, to expand group means such as mean(eu).
+
+    Returns
+    ----------
+    indicators: set
+       English names of the indicators the specs plot or derive from.
+    countries: set
+       English names of the countries plotted, compared or averaged.
+    '''
+    from hfa import aggregate, derived
+
+    sets = dict((k.lower(), v) for k, v in country_sets.items())
+    indicators, labels = set(), set()
+    for specs in plot_specs:
+        key = specs.get('indicator', '')
+        if derived.is_expression(key):
+            try:
+                needed, references = derived.dependencies(derived.parse(key, index))
+            except ValueError:
+                continue  # reported when the spec is rendered
+            indicators.update(needed)
+            labels.update(references)
+        elif index.get_name(key) is not None:
+            indicators.add(index.get_name(key))
+        labels.update(specs.get('countries', []))
+        labels.update(specs.get('comparators', None) or [])
+
+    countries = set()
+    for label in labels:
+        if label is None:
+            continue
+        match = aggregate.AGGREGATE.match(label) if isinstance(label, basestring) else None
+        if match is None:
+            countries.add(label)
+            continue
+        kind, group = match.groups()
+        countries.update(sets.get(group.lower(), []))
+        if kind == 'wmean':
+            indicators.add(index.get_name(aggregate.POPULATION))
+    return indicators, countries
@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar on-disk store for the HFA data.
+
+The store replaces the single pickled master DataFrame.
+Each indicator is kept in its own partition directory holding one
+NumPy array per column, which is opened via memory mapping so that
+only the partitions a run actually touches are paged in:
+
+    data/store/
+        manifest.json        dictionaries and the partition table
+        p0000/country_id.npy int16, sorted by (country_id, year)
+        p0000/year.npy       int16
+        p0000/value.npy      float64
+        segments/000001/     an appended segment, itself laid out
+                             as a small store of the same format
+
+Country names are dictionary-encoded through `country_id` and the
+indicator name is implied by the partition, so neither is repeated
+on disk per row.
+
+Imports append a new segment under a lock file instead of rewriting
+the base partitions. Reads merge the base with the segments of the
+requested indicator lazily, the newest value winning per
+(country, indicator, year); compaction folds the segments back into
+the base.
+
+When run as a main module, migrate data/master_frame.pkl into the store,
+or with the argument 'compact', compact the store.
+"""
+from __future__ import print_function
+import errno
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+DATA_DIR = os.path.join('.', 'data')
+STORE_DIR = os.path.join(DATA_DIR, 'store')
+LEGACY_PKL = os.path.join(DATA_DIR, 'master_frame.pkl')
+
+FORMAT_VERSION = 1
+MANIFEST = 'manifest.json'
+SEGMENTS = 'segments'
+LOCK = 'lock'
+COLUMNS = ['country_id', 'country', 'indicator', 'year', 'value']
+DTYPES = {'country_id': np.int16, 'year': np.int16, 'value': np.float64}
+
+
+class ColumnarStore(object):
+    '''
+    A directory of per-indicator, memory-mapped column files
+    plus an append-only log of segments.
+
+    Parameters
+    ----------
+    store_dir: string (optional)
+       Path to the store directory, defaults to ./data/store otherwise.
+       The directory is created on the first write.
+    '''
+
+    def __init__(self, store_dir=STORE_DIR):
+        self.store_dir = store_dir
+        self.manifest_path = os.path.join(store_dir, MANIFEST)
+        self.segment_dir = os.path.join(store_dir, SEGMENTS)
+        self.lock_path = os.path.join(store_dir, LOCK)
+        self.reload()
+
+    def reload(self):
+        '''Re-read the manifest and segment list and drop any mapped partitions.'''
+        try:
+            with open(self.manifest_path, 'r') as f:
+                self.manifest = json.load(f)
+        except IOError:
+            self.manifest = {'format': FORMAT_VERSION,
+                             'next': 0,
+                             'countries': {},
+                             'partitions': {}}
+        self.segments = [ColumnarStore(os.path.join(self.segment_dir, name))
+                         for name in self._segment_names()]
+        self._mapped = {}
+        self._names = None
+
+    def _segment_names(self):
+        try:
+            names = os.listdir(self.segment_dir)
+        except OSError:
+            return []
+        return sorted(name for name in names if name.isdigit())
+
+    @property
+    def exists(self):
+        return os.path.exists(self.manifest_path)
+
+    @property
+    def indicators(self):
+        indicators = set(self.manifest['partitions'])
+        for segment in self.segments:
+            indicators.update(segment.manifest['partitions'])
+        return sorted(indicators)
+
+    @property
+    def countries(self):
+        '''Dictionary of country_id -> country name.'''
+        countries = {}
+        for manifest in [self.manifest] + [s.manifest for s in self.segments]:
+            countries.update((int(k), v) for k, v in manifest['countries'].items())
+        return countries
+
+    @property
+    def version(self):
+        '''Changes whenever the store is written to.'''
+        return '{}-{}'.format(self.manifest['next'],
+                              ','.join(os.path.basename(s.store_dir)
+                                       for s in self.segments))
+
+    def __contains__(self, indicator):
+        return (indicator in self.manifest['partitions']
+                or any(indicator in s for s in self.segments))
+
+    def __len__(self):
+        return sum(len(self.partition(i)['year']) for i in self.indicators)
+
+    def partition(self, indicator):
+        '''
+        Return the columns of one indicator as a dict of arrays:
+        country_id, year and value. Rows are sorted by (country_id, year).
+
+        Without pending segments the arrays are read-only memory maps
+        of the base partition; otherwise the base and segments are
+        merged in memory, newest value winning.
+        '''
+        if indicator not in self._mapped:
+            parts = [s.partition(indicator) for s in self.segments
+                     if indicator in s]
+            if indicator in self.manifest['partitions']:
+                part_dir = os.path.join(self.store_dir,
+                                        self.manifest['partitions'][indicator])
+                parts.insert(0, dict(
+                    (col, np.load(os.path.join(part_dir, col + '.npy'),
+                                  mmap_mode='r'))
+                    for col in DTYPES))
+            if len(parts) == 1:
+                self._mapped[indicator] = parts[0]
+            else:
+                self._mapped[indicator] = dedupe_last(dict(
+                    (col, np.concatenate([p[col] for p in parts]))
+                    for col in DTYPES))
+        return self._mapped[indicator]
+
+    def release(self, indicator):
+        '''Forget the columns of one indicator read by partition().'''
+        self._mapped.pop(indicator, None)
+        for segment in self.segments:
+            segment.release(indicator)
+
+    def country_names(self, country_ids):
+        '''Decode an array of country ids into an object array of names.'''
+        if self._names is None:
+            countries = self.countries
+            size = max(countries) + 1 if countries else 0
+            self._names = np.empty(size, dtype=object)
+            for cid, name in countries.items():
+                self._names[cid] = name
+        return self._names.take(np.asarray(country_ids, dtype=np.intp))
+
+    def partition_frame(self, indicator):
+        '''Materialise one indicator partition as a long DataFrame.'''
+        part = self.partition(indicator)
+        n = len(part['year'])
+        indicators = np.empty(n, dtype=object)
+        indicators.fill(indicator)
+        frame = pd.DataFrame({'country_id': part['country_id'].astype(np.int64),
+                              'country': self.country_names(part['country_id']),
+                              'indicator': indicators,
+                              'year': part['year'].astype(np.int64),
+                              'value': np.array(part['value'])},
+                             columns=COLUMNS)
+        return frame
+
+    def to_frame(self, indicators=None):
+        '''
+        Return the data in the long format of the old master frame:
+        country_id, country, indicator, year, value.
+
+        Parameters
+        ----------
+        indicators: list of strings (optional)
+           English indicator names to load. If None, load all.
+        '''
+        if indicators is None:
+            indicators = self.indicators
+        frames = [self.partition_frame(i) for i in indicators if i in self]
+        if not frames:
+            return empty_frame()
+        return pd.concat(frames, ignore_index=True)
+
+    def append(self, df):
+        '''
+        Append a long DataFrame to the store as a new segment.
+        The cost depends only on the size of `df`, not of the store.
+        Returns the path of the new segment.
+        '''
+        if not len(df):
+            return None
+        if not os.path.exists(self.segment_dir):
+            os.makedirs(self.segment_dir)
+        with StoreLock(self.lock_path):
+            names = self._segment_names()
+            name = '{:06d}'.format(int(names[-1]) + 1 if names else 1)
+            tmp = os.path.join(self.segment_dir, '.tmp-' + name)
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+            ColumnarStore(tmp)._merge(df)
+            path = os.path.join(self.segment_dir, name)
+            os.rename(tmp, path)
+        self.reload()
+        return path
+
+    def compact(self):
+        '''Fold all segments into the base partitions and remove them.'''
+        self.update(empty_frame())
+
+    def update(self, df):
+        '''
+        Rewrite the base partitions with pending segments and `df`
+        merged in, then drop the folded segments. Only the partitions
+        of indicators present in the segments or `df` are rewritten;
+        on a clash of (country_id, year) within an indicator the rows
+        in `df` win.
+        '''
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+        with StoreLock(self.lock_path):
+            self.reload()
+            self._merge(df)
+
+    def _merge(self, df):
+        segments = self.segments
+        if not len(df) and not segments:
+            return
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+        self.manifest['countries'] = dict(
+            (str(cid), name) for cid, name in self.countries.items())
+        for cid, name in zip(df['country_id'], df['country']):
+            self.manifest['countries'][str(int(cid))] = name
+
+        frames = dict(list(df.groupby('indicator')))
+        touched = set(frames)
+        for segment in segments:
+            touched.update(segment.manifest['partitions'])
+
+        stale = []
+        for indicator in sorted(touched):
+            parts = [self.partition(indicator)] if indicator in self else []
+            if indicator in frames:
+                rows = frames[indicator]
+                parts.append(dict((col, np.asarray(rows[col], dtype=dtype))
+                                  for col, dtype in DTYPES.items()))
+            columns = dedupe_last(dict(
+                (col, np.concatenate([p[col] for p in parts]))
+                for col in DTYPES))
+            if indicator in self.manifest['partitions']:
+                stale.append(self.manifest['partitions'][indicator])
+            self.manifest['partitions'][indicator] = self._write_partition(columns)
+
+        self._write_manifest()
+        for name in stale:
+            shutil.rmtree(os.path.join(self.store_dir, name), ignore_errors=True)
+        for segment in segments:
+            shutil.rmtree(segment.store_dir, ignore_errors=True)
+        self.reload()
+
+    def _write_partition(self, columns):
+        name = 'p{:04d}'.format(self.manifest['next'])
+        self.manifest['next'] += 1
+        part_dir = os.path.join(self.store_dir, name)
+        if os.path.exists(part_dir):
+            # left behind by a write that never reached its manifest
+            shutil.rmtree(part_dir)
+        os.makedirs(part_dir)
+        for col in DTYPES:
+            np.save(os.path.join(part_dir, col + '.npy'), columns[col])
+        return name
+
+    def _write_manifest(self):
+        '''Atomically replace the manifest: the commit point of a write.
+        Partitions are always written to fresh directories, so readers
+        see either the old or the new set, never a mix.'''
+        tmp = self.manifest_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        replace_file(tmp, self.manifest_path)
+
+
+class StoreLock(object):
+    '''
+    Exclusive writer lock on a store, held as a lock file created
+    with O_EXCL. Use as a context manager.
+
+    Parameters
+    ----------
+    path: string
+       Path of the lock file.
+    timeout: float (optional)
+       Seconds to wait for another writer before raising IOError.
+    '''
+
+    def __init__(self, path, timeout=60, poll=0.1):
+        self.path = path
+        self.timeout = timeout
+        self.poll = poll
+
+    def __enter__(self):
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                if time.time() > deadline:
+                    raise IOError('Timed out waiting for store lock {}; '
+                                  'remove it if no import is running.'
+                                  .format(self.path))
+                time.sleep(self.poll)
+            else:
+                os.write(fd, str(os.getpid()))
+                os.close(fd)
+                return self
+
+    def __exit__(self, *exc_info):
+        os.remove(self.path)
+
+
+def empty_frame():
+    '''An empty long-format DataFrame with the usual column dtypes.'''
+    return pd.DataFrame({'country_id': np.array([], dtype=np.int64),
+                         'country': np.array([], dtype=object),
+                         'indicator': np.array([], dtype=object),
+                         'year': np.array([], dtype=np.int64),
+                         'value': np.array([], dtype=np.float64)},
+                        columns=COLUMNS)
+
+
+def year_window(years, start=None, end=None):
+    '''
+    Return the (lo, hi) slice of the inclusive range `start` to `end`
+    (None for open) on a contiguous ascending year axis.
+    '''
+    lo = 0 if start is None else max(0, start - int(years[0]))
+    hi = len(years) if end is None else max(0, end - int(years[0]) + 1)
+    return lo, hi
+
+
+def long_frame(cids, labels, years, block, indicator):
+    '''
+    Return the long-format rows of a (countries, years) block of
+    values, sorted by year and skipping NaN.
+
+    Parameters
+    ----------
+    cids, labels: lists
+       The country_id and country name of each row of `block`.
+    years: int array
+       The year of each column of `block`.
+    indicator: unicode
+       The indicator column of every row.
+    '''
+    r, c = np.nonzero(~np.isnan(block))
+    if not len(r):
+        return empty_frame()
+    order = np.argsort(c, kind='mergesort')
+    r, c = r[order], c[order]
+    names = np.empty(len(r), dtype=object)
+    names[:] = [labels[i] for i in r]
+    indicators = np.empty(len(r), dtype=object)
+    indicators.fill(indicator)
+    return pd.DataFrame({'country_id': np.asarray(cids, dtype=np.int64)[r],
+                         'country': names,
+                         'indicator': indicators,
+                         'year': years[c],
+                         'value': block[r, c]},
+                        columns=COLUMNS)
+
+
+def replace_file(src, dst):
+    '''Rename src over dst, atomically where the OS allows it.'''
+    try:
+        os.rename(src, dst)
+    except OSError:
+        # Windows will not rename over an existing file
+        os.remove(dst)
+        os.rename(src, dst)
+
+
+def dedupe_last(columns):
+    '''
+    Sort a dict of column arrays by (country_id, year) and keep only
+    the last occurrence of every key.
+    '''
+    n = len(columns['year'])
+    order = np.lexsort((np.arange(n), columns['year'], columns['country_id']))
+    cid = columns['country_id'][order]
+    year = columns['year'][order]
+    keep = np.ones(n, dtype=bool)
+    keep[:-1] = (cid[1:] != cid[:-1]) | (year[1:] != year[:-1])
+    order = order[keep]
+    return dict((col, np.ascontiguousarray(columns[col][order], dtype=dtype))
+                for col, dtype in DTYPES.items())
+
+
+def migrate_pickle(pkl=LEGACY_PKL, store_dir=STORE_DIR):
+    '''One-shot migration of a pickled master DataFrame into a store.'''
+    from hfa.coverage import Coverage  # it imports this module
+    df = pd.read_pickle(pkl)
+    store = ColumnarStore(store_dir)
+    store.update(df)
+    Coverage.build(store).save(store_dir)
+    print('Migrated {} rows from {} into {} ({} indicators, {} rows)'.format(
+        len(df), pkl, store_dir, len(store.indicators), len(store)))
+    return store
+
+
+def main(args=sys.argv[1:]):
+    if args and args[0] == 'compact':
+        from hfa.coverage import Coverage
+        store = ColumnarStore()
+        count = len(store.segments)
+        before = store.version
+        store.compact()
+        Coverage.refresh(store, [], before)
+        print('Compacted {} segments into {}'.format(count, STORE_DIR))
+        return
+    if os.path.exists(os.path.join(STORE_DIR, MANIFEST)):
+        print('Store already exists at {}, nothing to do.'.format(STORE_DIR))
+        return
+    migrate_pickle()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight timing and memory instrumentation for the pipeline.
+
+Wrap a stage in a span:
+
+    from hfa import trace
+    with trace.span('plot.dataset', spec='1320_cis'):
+        ...
+
+Tracing is off unless the HFA_TRACE environment variable is set (to 1,
+or to the path of the trace file) or trace.enable() is called, e.g.
+by main.py --trace. When off, span() returns a shared no-op context
+manager. When on, every span records its start, duration, nesting
+depth and the process peak resident memory at exit, and save() writes
+them as JSON with a per-spec breakdown.
+"""
+import json
+import os
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+ENV = 'HFA_TRACE'
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self, tracer, name, meta):
+        self.tracer = tracer
+        self.record = {'name': name, 'pid': os.getpid()}
+        self.record.update(meta)
+
+    def __enter__(self):
+        stack = self.tracer.stack
+        self.record['depth'] = len(stack)
+        self.record['parent'] = stack[-1]['name'] if stack else None
+        if stack and 'spec' in stack[-1]:
+            # nested spans are attributed to the enclosing spec
+            self.record.setdefault('spec', stack[-1]['spec'])
+        stack.append(self.record)
+        self.record['start'] = time.time() - self.tracer.origin
+        self._clock = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.record['seconds'] = time.time() - self._clock
+        self.record['peak_rss_kb'] = peak_rss_kb()
+        if exc_type is not None:
+            self.record['error'] = exc_type.__name__
+        self.tracer.stack.pop()
+        self.tracer.records.append(self.record)
+        return False
+
+
+class Tracer(object):
+    '''Collects span records for one process.'''
+
+    def __init__(self, enabled=False, path=None):
+        self.enabled = enabled
+        self.path = path
+        self.origin = time.time()
+        self.stack = []
+        self.records = []
+
+    def span(self, name, **meta):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, meta)
+
+    def drain(self):
+        '''Return and forget the records collected so far, e.g. to
+        ship them from a worker process to the parent.'''
+        records, self.records = self.records, []
+        return records
+
+    def save(self, path=None):
+        '''Write the run's spans and per-spec totals as JSON; return the path.'''
+        path = path or self.path or 'trace_{}_{}.json'.format(
+            time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+        specs = {}
+        for record in self.records:
+            if 'spec' in record:
+                totals = specs.setdefault(record['spec'], {})
+                totals[record['name']] = (totals.get(record['name'], 0)
+                                          + record['seconds'])
+        with open(path, 'w') as f:
+            json.dump({'spans': self.records,
+                       'specs': specs,
+                       'peak_rss_kb': peak_rss_kb()}, f, indent=1, sort_keys=True)
+        return path
+
+
+def peak_rss_kb():
+    '''Peak resident set size of this process in KB, None if unknown.'''
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _from_environment():
+    value = os.environ.get(ENV, '')
+    if value in ('', '0'):
+        return Tracer()
+    return Tracer(True, None if value == '1' else value)
+
+
+TRACER = _from_environment()
+
+
+def span(name, **meta):
+    '''Time the enclosed block as `name`; `meta` is stored with it.'''
+    return TRACER.span(name, **meta)
+
+
+def enable(path=None):
+    TRACER.enabled = True
+    TRACER.path = path or TRACER.path
+
+
+def enabled():
+    return TRACER.enabled
+
+
+def drain():
+    return TRACER.drain()
+
+
+def current(key):
+    '''The value of `key` in this thread's innermost open span, or None.'''
+    stack = TRACER.stack
+    return stack[-1].get(key) if stack else None
+
+
+def record(name, start, seconds, **meta):
+    '''
+    Build the record of work timed outside span(), e.g. in another
+    thread, where the span stack does not apply; add it with extend().
+    `start` is a time.time() value.
+    '''
+    result = {'name': name, 'pid': os.getpid(), 'depth': 0, 'parent': None,
+              'start': start - TRACER.origin, 'seconds': seconds,
+              'peak_rss_kb': peak_rss_kb()}
+    result.update((k, v) for k, v in meta.items() if v is not None)
+    return result
+
+
+def extend(records):
+    '''Add records drained from another process.'''
+    TRACER.records.extend(records)
+
+
+def save(path=None):
+    return TRACER.save(path)
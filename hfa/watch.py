@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Resident watch mode: keep the data, index and specs in memory, poll
+for new raw data and edited files, and re-render only the affected
+specs.
+
+Changes are found by polling modification times:
+
+    data/raw/*.html                 imported in place as a new store
+                                    segment; re-renders the specs that
+                                    plot an imported (indicator, country)
+    yaml/<spec>.yaml                re-reads and re-renders that spec
+    yaml/config.yaml,
+    hfa/index_data/country_sets.yaml,
+    hfa/index_data/raw_*.txt        re-read and re-render every spec
+
+Charts whose fingerprint is unchanged are still skipped by the render
+cache, so an affected spec with identical output costs no drawing.
+"""
+from __future__ import print_function
+import glob
+import os
+import time
+import traceback
+
+from hfa.aggregate import Aggregator
+from hfa.derived import DerivedIndicators
+from hfa.importer import DataImporter
+from hfa.indices import HFAIndex
+from hfa.specs import (CONFIG, COUNTRY_SETS, IDX_DIR, check_specs,
+                       load_country_sets, load_spec, read_yaml_file,
+                       spec_files, spec_requirements)
+
+INDEX_FILES = os.path.join(IDX_DIR, 'raw_*.txt')
+
+
+def snapshot(paths):
+    '''Return {path: modification time} of the paths that exist.'''
+    mtimes = {}
+    for path in paths:
+        try:
+            mtimes[path] = os.path.getmtime(path)
+        except OSError:
+            pass
+    return mtimes
+
+
+class Watcher(object):
+    '''
+    Parameters
+    ----------
+    render: callable
+       render(plot_specs, hfa_db, index, coverage) renders a list of
+       specs, e.g. main.render_all with a RenderCache.
+    interval: float (optional)
+       Seconds between polls.
+    processes: int (optional)
+       Import process pool size.
+    '''
+
+    def __init__(self, render, interval=2.0, processes=None):
+        self.render = render
+        self.interval = interval
+        self.processes = processes
+        self.importer = DataImporter(processes=processes)
+        self.index = HFAIndex()
+        self.specs = {}
+        self.requirements = {}
+        self.pending = []  # imported frames not yet rendered
+        self.mtimes = snapshot(self._watched())
+        self._load_specs()
+        self._rebuild_data()
+
+    def _watched(self):
+        return (spec_files() + [CONFIG, COUNTRY_SETS]
+                + glob.glob(INDEX_FILES))
+
+    def _load_specs(self, paths=None):
+        '''(Re)load the given spec files, or all of them.'''
+        self.country_sets = load_country_sets()
+        self.config = read_yaml_file(CONFIG)
+        if paths is None:
+            self.specs, self.requirements = {}, {}
+            paths = spec_files()
+        for path in paths:
+            self.specs.pop(path, None)
+            self.requirements.pop(path, None)
+            if not os.path.exists(path):
+                continue
+            try:
+                specs = load_spec(path, self.config, self.country_sets)
+            except Exception:
+                print('Could not read {}:\n{}'.format(path, traceback.format_exc()))
+                continue
+            self.specs[path] = specs
+            self.requirements[path] = spec_requirements(
+                [specs], self.index, self.country_sets)
+
+    def _rebuild_data(self):
+        # only what the current specs read, as in main.main()
+        indicators, countries = set(), set()
+        for needed, plotted in self.requirements.values():
+            indicators.update(needed)
+            countries.update(plotted)
+        series = self.importer.select(indicators, countries)
+        self.hfa_db = DerivedIndicators(
+            Aggregator(series, self.index, self.country_sets), self.index)
+
+    def render_all(self):
+        self._render(sorted(self.specs))
+
+    def _render(self, paths):
+        plot_specs, _ = check_specs([self.specs[p] for p in paths],
+                                    self.index, self.importer.coverage)
+        if plot_specs:
+            self.render(plot_specs, self.hfa_db, self.index,
+                        self.importer.coverage)
+
+    def poll(self):
+        '''Check once for changes and re-render the affected specs.
+        Returns the paths of the specs that were rendered.'''
+        new = self.importer.import_raw(self.processes)
+        if new is not None and len(new):
+            self.pending.append(new)
+        mtimes = snapshot(self._watched())
+        changed = set(path for path in set(mtimes) | set(self.mtimes)
+                      if mtimes.get(path) != self.mtimes.get(path))
+        if not changed and not self.pending:
+            return []
+
+        affected = set()
+        if any(p.startswith(os.path.join(IDX_DIR, 'raw_')) for p in changed):
+            self.index = HFAIndex()
+            changed.add(CONFIG)
+        if CONFIG in changed or COUNTRY_SETS in changed:
+            self._load_specs()
+            affected.update(self.specs)
+        else:
+            edited = changed.intersection(spec_files()) | (changed - set(mtimes))
+            self._load_specs(edited)
+            affected.update(p for p in edited if p in self.specs)
+
+        for new in self.pending:
+            indicators, countries = set(new['indicator']), set(new['country'])
+            affected.update(path for path, (needed, plotted)
+                            in self.requirements.items()
+                            if needed & indicators and plotted & countries)
+
+        self._rebuild_data()
+        # only now, so that a failed poll is retried
+        self.mtimes, self.pending = mtimes, []
+        affected = sorted(affected)
+        if affected:
+            print('Re-rendering {} spec(s)'.format(len(affected)))
+            self._render(affected)
+        return affected
+
+    def run(self):
+        '''Render everything once, then poll until interrupted.'''
+        self.render_all()
+        print('Watching for changes every {}s; press Ctrl-C to stop.'.format(
+            self.interval))
+        try:
+            while True:
+                time.sleep(self.interval)
+                try:
+                    self.poll()
+                except Exception:
+                    # e.g. a file removed mid-read: report, retry next poll
+                    print(traceback.format_exc())
+        except KeyboardInterrupt:
+            pass
@@ -3,66 +3,336 @@
 Created on Sat Oct 19 13:46:49 2013
 
 @author: Gauden Galea
+
+Command line interface:
+
+    python main.py [render] [-j N] [-f] [--trace [FILE]]
+    python main.py import [-p N] [--compact]
+    python main.py index [--rebuild]
+    python main.py search QUERY [-n 10] [--lang ru]
+    python main.py export [ids ...] [--format npz] [--labels ru]
+    python main.py serve [--port 8765]
+    python main.py watch [-i 2]
+
+Each command imports only the modules it needs, so quick commands
+such as search do not load pandas or matplotlib.
 """
 from __future__ import print_function
-import glob
+import argparse
+import multiprocessing
 import os
-import yaml
+import sys
+import traceback
+
+from hfa import trace
+from hfa.specs import (CONFIG, IDX_DIR, load_country_sets, load_spec,
+                       read_yaml_file, spec_files, spec_name)
+
+# Data shared with render workers, set before the pool forks
+_SHARED = {}
+
+
+def get_yaml():
+    basic_config = read_yaml_file(CONFIG)
+    country_sets = load_country_sets()
+    return [load_spec(yaml_file, basic_config, country_sets)
+            for yaml_file in spec_files()]
+
+
+def render_spec(specs):
+    """Build and render one plot; return (name, traceback or None,
+    dict of output path -> fingerprint rendered, trace records)."""
+    from hfa.plot import Plot
+    name = spec_name(specs)
+    try:
+        with trace.span('spec', spec=str(name)):
+            with trace.span('plot.dataset'):
+                plot = Plot(specs, _SHARED['index'], _SHARED['hfa_db'],
+                            _SHARED['coverage'])
+            rendered = plot.render(_SHARED['cache'], _SHARED['writer'])
+        return name, None, rendered, trace.drain()
+    except Exception:
+        return name, traceback.format_exc(), {}, trace.drain()
 
-from hfa.importer import DataImporter
-from hfa.indices import HFAIndex
-from hfa.plot import Plot
 
-YAML_DIR = os.path.join('yaml')
-IDX_DIR = os.path.join('hfa', 'index_data')
+def _init_worker(hfa_db, index, cache, output, coverage):
+    # Forked workers inherit the memory-mapped data and index from the
+    # parent instead of loading their own copies
+    from hfa.output import FigureWriter
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+    trace.drain()  # spans inherited from the parent are reported there
+    # the processes already overlap drawing and encoding
+    writer = FigureWriter(compression=output.get('compression', 6))
+    _SHARED.update(hfa_db=hfa_db, index=index, cache=cache, writer=writer,
+                   coverage=coverage)
 
 
-def read_yaml_file(yaml_file):
-    with open(yaml_file, 'rb') as f:
-        specs = yaml.load(f.read())
-        print('Processed: {}'.format(yaml_file))
-    return specs
+def render_all(plot_specs, hfa_db, index, jobs=1, cache=None, output=None,
+               coverage=None):
+    """Render every spec, spreading them over `jobs` processes.
+    Charts found fresh in `cache` are skipped; the cache is updated
+    with what was rendered (by this process only, so workers never
+    race on the manifest). `output` holds the hfa.output.FigureWriter
+    options; bundles need a single process. Default axis limits are
+    read from `coverage`, a hfa.coverage.Coverage, where it is exact.
+    Returns the list of (name, traceback) of specs, or files, that
+    failed."""
+    from hfa.output import FigureWriter
+    output = output or {}
+    if jobs > 1 and len(plot_specs) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(plot_specs)),
+                                    initializer=_init_worker,
+                                    initargs=(hfa_db, index, cache, output,
+                                              coverage))
+        try:
+            results = pool.imap_unordered(render_spec, plot_specs)
+            failures = _report(results, len(plot_specs), cache)
+        finally:
+            pool.close()
+            pool.join()
+        return failures
 
+    writer = FigureWriter(**output)
+    _SHARED.update(hfa_db=hfa_db, index=index, cache=cache, writer=writer,
+                   coverage=coverage)
+    try:
+        failures = _report((render_spec(s) for s in plot_specs),
+                           len(plot_specs), cache)
+    finally:
+        errors = writer.close()
+    for path, error in errors:
+        # drawn, but never written: render again next time
+        print('FAILED writing {}:\n{}'.format(path, error))
+        failures.append((path, error))
+        if cache is not None:
+            cache.entries.pop(path, None)
+    if writer.bundle_path:
+        print('Bundled {} charts in {}'.format(writer.bundled, writer.bundle_path))
+    return failures
 
-def expand_country_sets(countries):
-    result = []
-    country_sets = read_yaml_file(os.path.join(IDX_DIR, 'country_sets.yaml'))
-    for idx in countries:
-        if idx in country_sets:
-            result.extend(country_sets[idx])
+
+def _report(results, total, cache):
+    failures = []
+    for done, (name, error, rendered, spans) in enumerate(results, 1):
+        trace.extend(spans)
+        if error:
+            failures.append((name, error))
+            print('[{}/{}] FAILED {}:\n{}'.format(done, total, name, error))
+        elif cache is not None and not rendered:
+            print('[{}/{}] Unchanged {}'.format(done, total, name))
         else:
-            result.append(idx)
-    return set(result)
+            print('[{}/{}] Rendered {}'.format(done, total, name))
+        if cache is not None and rendered:
+            cache.update(rendered)
+    return failures
 
 
-def get_yaml():
-    plots = []
-    basic_config = read_yaml_file(os.path.join(YAML_DIR, "config.yaml"))
-    files = [f for f in glob.glob(os.path.join(YAML_DIR, "*.yaml"))]
-    if files:
-        for yaml_file in files:
-            if 'config' not in yaml_file:
-                specs = read_yaml_file(yaml_file)  # read specific config
-                final = basic_config.copy() if basic_config else dict() # merge it with general config
-                final.update(specs)
-                final['countries'] = expand_country_sets(final['countries'])
-                # TODO generalise this
-                if final['indicator'] == 176:
-                    final['indicator'] = '0260'
-                plots.append(final)  # add final result to list of plots
-    return plots
-
-def main():
-    hfa_db = DataImporter().DF
-    index = HFAIndex()
-    plot_specs = get_yaml()
+def main(jobs=1, force=False, trace_file=None, output=None):
+    from hfa.aggregate import Aggregator
+    from hfa.derived import DerivedIndicators
+    from hfa.importer import DataImporter
+    from hfa.indices import HFAIndex
+    from hfa.render_cache import RenderCache
+    from hfa.specs import check_specs, spec_requirements
+
+    if trace_file:
+        trace.enable(None if trace_file is True else trace_file)
+    with trace.span('get_yaml'):
+        plot_specs = get_yaml()
+    with trace.span('HFAIndex'):
+        index = HFAIndex()
+    with trace.span('DataImporter'):
+        importer = DataImporter()
+    # Charts that would be empty are rejected before anything is drawn
+    with trace.span('check_specs'):
+        plot_specs, failures = check_specs(plot_specs, index, importer.coverage)
+    # Only the indicators and countries the specs refer to are loaded
+    country_sets = load_country_sets()
+    indicators, countries = spec_requirements(plot_specs, index, country_sets)
+    series = importer.select(indicators, countries)
+    # comparators may name group means such as mean(eu) or wmean(cis),
+    # and indicators may be derived expressions such as rolling(1320, 3)
+    hfa_db = DerivedIndicators(Aggregator(series, index, country_sets), index)
+    cache = RenderCache()
+    if force:
+        cache.entries = {}
     if plot_specs:
-        for specs in plot_specs:
-            plot = Plot(specs, index, hfa_db)
-            plot.render()
-            #print(plot)
-    print('Run completed.')
+        failures += render_all(plot_specs, hfa_db, index, jobs, cache, output,
+                               importer.coverage)
+        cache.save()
+    if trace.enabled():
+        print('Trace written to {}'.format(trace.save()))
+    if failures:
+        print('Run completed with {} failed specs: {}'.format(
+            len(failures), ', '.join(str(name) for name, _ in failures)))
+    else:
+        print('Run completed.')
+    return failures
+
+
+def render_command(args):
+    if args.bundle and args.jobs > 1:
+        args.parser.error('--bundle needs a single render process (-j 1)')
+    output = {'workers': args.encoders, 'depth': args.queue,
+              'compression': args.compression, 'bundle': args.bundle}
+    # a bundle holds every chart, so none may be skipped as unchanged
+    return 1 if main(jobs=args.jobs, force=args.force or bool(args.bundle),
+                     trace_file=args.trace, output=output) else 0
+
+
+def import_command(args):
+    from hfa.importer import DataImporter
+    importer = DataImporter(processes=args.processes)
+    if args.compact:
+        importer.compact()
+    store = importer.store
+    print('Store has {} indicators, {} countries, {} pending segments.'.format(
+        len(store.indicators), len(store.countries), len(store.segments)))
+
+
+def index_command(args):
+    from hfa.indices import Extractor
+    if args.rebuild:
+        cache = os.path.join(IDX_DIR, Extractor.CACHE)
+        if os.path.exists(cache):
+            os.remove(cache)
+    records = Extractor(IDX_DIR).records
+    print('Index has {} countries and {} indicators.'.format(
+        len(records['countries']), len(records['indicators'])))
+
+
+def search_command(args):
+    from hfa.indices import Extractor
+    from hfa.search import IndicatorSearch
+    records = Extractor(IDX_DIR).records['indicators']
+    names = dict((idx, (en, ru)) for idx, en, ru in records)
+    query = ' '.join(args.query).decode(sys.stdin.encoding or 'utf-8')
+    for idx in IndicatorSearch(records).ids(query, args.limit):
+        name = names[idx][0 if args.lang == 'en' else 1]
+        print(u'{}  {}'.format(idx, name).encode('utf-8'))
+
+
+def export_command(args):
+    from hfa.export import export_all
+    try:
+        export_all(args.output, args.format, args.labels, args.ids,
+                   args.processes)
+    except ValueError as e:  # e.g. ids without data
+        args.parser.error(str(e))
+
+
+def watch_command(args):
+    from hfa.render_cache import RenderCache
+    from hfa.watch import Watcher
+    cache = RenderCache()
+    if args.force:
+        cache.entries = {}
+
+    def render(plot_specs, hfa_db, index, coverage):
+        failures = render_all(plot_specs, hfa_db, index, args.jobs, cache,
+                              coverage=coverage)
+        cache.save()
+        return failures
+    Watcher(render, args.interval, args.processes).run()
+
+
+def serve_command(args):
+    from hfa.server import serve
+    serve(args.host, args.port, args.cache, args.verbose)
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='HFA database processor.')
+    commands = parser.add_subparsers(title='commands', metavar='COMMAND')
+
+    render = commands.add_parser('render', help='render the plots in yaml/ '
+                                                '(the default command)')
+    render.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of render processes (default 1)')
+    render.add_argument('-f', '--force', action='store_true',
+                        help='re-render charts even if they are unchanged')
+    render.add_argument('--encoders', type=int, default=1,
+                        help='PNG encoder threads per render process; 0 '
+                             'encodes while drawing waits (default 1)')
+    render.add_argument('--queue', type=int, default=4,
+                        help='charts waiting for an encoder before drawing '
+                             'waits too (default 4)')
+    render.add_argument('--compression', type=int, default=6,
+                        choices=range(10), metavar='0-9',
+                        help='PNG compression level (default 6, the same '
+                             'files as savefig)')
+    render.add_argument('--bundle', choices=['pdf', 'svg'],
+                        help='also collect every chart into img/charts.pdf '
+                             'or img/charts.svg.zip (implies -f)')
+    render.add_argument('--trace', nargs='?', const=True, metavar='FILE',
+                        help='write per-stage timings and peak memory to a '
+                             'JSON trace (or set HFA_TRACE)')
+    render.set_defaults(func=render_command, parser=render)
+
+    imports = commands.add_parser('import', help='import new files from '
+                                                 'data/raw into the store')
+    imports.add_argument('-p', '--processes', type=int, default=None,
+                         help='parser process pool size (default: CPU count)')
+    imports.add_argument('--compact', action='store_true',
+                         help='fold imported segments into the base store')
+    imports.set_defaults(func=import_command)
+
+    index = commands.add_parser('index', help='parse the country and '
+                                              'indicator index files')
+    index.add_argument('--rebuild', action='store_true',
+                       help='ignore the cached records')
+    index.set_defaults(func=index_command)
+
+    search = commands.add_parser('search', help='find indicators by name')
+    search.add_argument('query', nargs='+')
+    search.add_argument('-n', '--limit', type=int, default=10)
+    search.add_argument('--lang', choices=['en', 'ru'], default='en')
+    search.set_defaults(func=search_command)
+
+    export = commands.add_parser('export', help='export wide country x year '
+                                                'tables per indicator')
+    export.add_argument('ids', nargs='*', help='indicator ids (default all)')
+    export.add_argument('-o', '--output', default='export',
+                        help='output directory (default ./export)')
+    export.add_argument('--format', choices=['csv', 'npz'], default='csv')
+    export.add_argument('--labels', choices=['en', 'ru'],
+                        help='add country names in this language')
+    export.add_argument('-p', '--processes', type=int, default=None,
+                        help='export process pool size (default: CPU count)')
+    export.set_defaults(func=export_command, parser=export)
+
+    watch = commands.add_parser('watch', help='re-render the specs affected '
+                                              'by new data or edited files')
+    watch.add_argument('-i', '--interval', type=float, default=2.0,
+                       help='seconds between checks (default 2)')
+    watch.add_argument('-j', '--jobs', type=int, default=1,
+                       help='number of render processes (default 1)')
+    watch.add_argument('-p', '--processes', type=int, default=None,
+                       help='import process pool size (default: CPU count)')
+    watch.add_argument('-f', '--force', action='store_true',
+                       help='re-render every chart on start')
+    watch.set_defaults(func=watch_command)
+
+    serve = commands.add_parser('serve', help='serve time series as JSON')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8765)
+    serve.add_argument('--cache', type=int, default=256,
+                       help='number of responses kept in the LRU cache')
+    serve.add_argument('-v', '--verbose', action='store_true',
+                       help='log every request')
+    serve.set_defaults(func=serve_command)
+    return parser
+
+
+def cli(argv):
+    parser = make_parser()
+    # Without a command, render as main.py always did
+    if not argv or argv[0].startswith('-') and argv[0] not in ('-h', '--help'):
+        argv = ['render'] + argv
+    args = parser.parse_args(argv)
+    return args.func(args)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(cli(sys.argv[1:]))